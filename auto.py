@@ -1,13 +1,23 @@
 #!/bin/env python
 
-from itertools import combinations
-from typing import Tuple, Iterable, Iterator
+import hashlib
+from collections import defaultdict
+from itertools import chain, combinations, islice, product
+from typing import Tuple, Iterable, Iterator, List, Set, Union
 
 import numpy as np
 from ase.atoms import Atoms
 from ase.geometry import get_layers
 from numpy.linalg import  norm
 
+import instrumentation
+from instrumentation import count, span
+from orientation import ClashChecker, gen_poses, is_linear, rotation_grid
+from placement import Placement, SlabTemplate
+from site_cache import SiteCache
+from sites import SiteIndex
+from symmetry import gen_unique_sites
+
 import logging
 
 logger = logging.getLogger('curlywaddly')
@@ -70,6 +80,143 @@ def valid_comb(indices, atoms, expanded_atoms, cutoff_dist):
            and valid_dist(indices, expanded_atoms, cutoff_dist)
 
 
+class SiteClassifier:
+    """
+    Batched classification of candidate sites of an expanded surface.
+    Candidate sites are given as (m, k) arrays of atom indices and are
+    scored a whole block at a time with array operations.
+    Points on the cell boundary are assigned to the half-open cell [0, 1)
+    within `tol`, so exactly one periodic image of each point is inside
+    """
+    def __init__(self, cell, positions: np.ndarray, cutoff_dist: float,
+                 inside: np.ndarray=None, dims: int=2, tol: float=1e-8):
+        """
+        :param cell: cell used to check if points are inside the unit cell
+        :param positions: (n, 3) positions of the expanded surface
+        :param cutoff_dist: maximum distance between atoms of a site
+        :param inside: (n,) mask of atoms considered inside the unit cell,
+            computed from `cell` if not given
+        :param dims: number of scaled coordinates checked by `in_cell`
+        :param tol: tolerance in scaled coordinates for the cell boundary
+        """
+        self.inv_cell = np.linalg.inv(np.asarray(cell))
+        self.positions = np.asarray(positions, dtype=float)
+        self.cutoff_dist = cutoff_dist
+        self.dims = dims
+        self.tol = tol
+        self.distances = norm(self.positions[:, None] - self.positions[None], axis=2)
+        if inside is None:
+            inside = self.in_cell(self.positions)
+        self.inside = np.asarray(inside, dtype=bool)
+
+    def scale(self, points: np.ndarray) -> np.ndarray:
+        return np.asarray(points) @ self.inv_cell
+
+    def in_cell(self, points: np.ndarray) -> np.ndarray:
+        scaled = self.scale(points)[..., :self.dims] + self.tol
+        return np.all((0 <= scaled) & (scaled < 1), axis=-1)
+
+    def valid_dist(self, indices: np.ndarray) -> np.ndarray:
+        valid = np.ones(len(indices), dtype=bool)
+        for i, j in combinations(range(indices.shape[1]), 2):
+            valid &= self.distances[indices[:, i], indices[:, j]] < self.cutoff_dist
+        return valid
+
+    def valid_comb(self, indices: np.ndarray) -> np.ndarray:
+        inside = self.inside[indices].any(axis=1)
+        valid_dist = self.valid_dist(indices)
+        if instrumentation.enabled:
+            size = indices.shape[1]
+            count('site_tuples_tested', len(indices), size=size)
+            count('site_tuples_rejected', np.count_nonzero(~valid_dist),
+                  size=size, reason='distance')
+            count('site_tuples_rejected', np.count_nonzero(valid_dist & ~inside),
+                  size=size, reason='cell')
+        return inside & valid_dist
+
+    def midpoints(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Mean position of pairs, incenter of the first three atoms otherwise
+        :param indices: (m, k) array of atom indices
+        :return: (m, 3) array of positions
+        """
+        positions = self.positions[indices]
+        if indices.shape[1] == 2:
+            return positions.mean(axis=1)
+        return get_incenters(positions[:, 0], positions[:, 1], positions[:, 2])
+
+
+def gen_blocks(indices: Iterable[Tuple[int, ...]], size: int,
+               block_size: int=4096) -> Iterator[np.ndarray]:
+    """
+    Groups tuples of indices in (block_size, size) arrays
+    :param indices: iterable of tuples of `size` indices
+    :param size: length of each tuple
+    :param block_size: maximum number of tuples per block
+    :return: integer arrays
+    """
+    indices = iter(indices)
+    while True:
+        block = np.fromiter(chain.from_iterable(islice(indices, block_size)), dtype=int)
+        if not block.size:
+            return
+        yield block.reshape(-1, size)
+
+
+def neighbor_graph(positions: np.ndarray, cutoff_dist: float) -> List[Set[int]]:
+    """
+    Builds the neighbor graph of `positions` using a cell list, two points
+    are neighbors if their distance is strictly smaller than `cutoff_dist`
+    :param positions: (n, 3) array of cartesian positions
+    :param cutoff_dist: neighbor cutoff distance
+    :return: list with the set of neighbor indices of each point
+    """
+    positions = np.asarray(positions, dtype=float)
+    neighbors = [set() for _ in range(len(positions))]
+    if not len(positions):
+        return neighbors
+
+    # bin points in cubic cells with side `cutoff_dist`
+    bins = np.floor((positions - positions.min(axis=0)) / cutoff_dist).astype(int)
+    cells = defaultdict(list)
+    for i, b in enumerate(map(tuple, bins)):
+        cells[b].append(i)
+
+    offsets = list(product((-1, 0, 1), repeat=3))
+    for b, members in cells.items():
+        candidates = [j for offset in offsets
+                      for j in cells.get(tuple(np.add(b, offset)), ())]
+        d = norm(positions[members][:, None] - positions[candidates][None], axis=2)
+        for m, c in zip(*np.nonzero(d < cutoff_dist)):
+            i, j = members[m], candidates[c]
+            if i != j:
+                neighbors[i].add(j)
+    return neighbors
+
+
+def gen_cliques(neighbors: List[Set[int]], size: int) -> Iterator[Tuple[int, ...]]:
+    """
+    Yields all cliques of `size` points of the neighbor graph, in the same
+    lexicographic order as `itertools.combinations`
+    :param neighbors: list with the set of neighbor indices of each point
+    :param size: number of points in the clique
+    :return: sorted tuples of indices
+    """
+    def extend(clique, candidates):
+        if len(clique) == size:
+            yield tuple(clique)
+            return
+        # not enough candidates left to complete the clique
+        if len(clique) + len(candidates) < size:
+            return
+        for k, j in enumerate(candidates):
+            yield from extend(clique + [j],
+                              [c for c in candidates[k+1:] if c in neighbors[j]])
+
+    for i, neighbors_i in enumerate(neighbors):
+        yield from extend([i], sorted(j for j in neighbors_i if j > i))
+
+
 def distance(point1, point2):
     return norm(point1 - point2)
 
@@ -88,54 +235,181 @@ def get_incenter(point1, point2, point3):
     return np.array( (Ox, Oy, Oz) )
 
 
-def gen_midpoints(slab: Atoms, cutoff_dist: float=3.5, heights: Iterable[float]=None, **kw):
+def get_incenters(points1, points2, points3):
+    """
+    Vectorized `get_incenter` over (m, 3) arrays of points
+    """
+    a = norm(points2 - points3, axis=1)[:, None]
+    b = norm(points1 - points3, axis=1)[:, None]
+    c = norm(points1 - points2, axis=1)[:, None]
+    p = a + b + c
+    incenters = (a*points1 + b*points2 + c*points3) / p
+    incenters[:, 2] = np.mean((points1[:, 2], points2[:, 2], points3[:, 2]), axis=0)
+    return incenters
+
+
+def gen_midpoints(slab: Atoms, cutoff_dist: float=3.5, heights: Iterable[float]=None,
+                  method: str='graph', symmetry: bool=False, tol: float=0.05, **kw):
     """
 
     :param slab:
     :param cutoff_dist:
     :param heights:
+    :param method: 'graph' walks the cliques of the cutoff neighbor graph,
+        'combinations' tests every combination of atoms (slow, reference)
+    :param symmetry: yield only one site per symmetry orbit of the slab,
+        with the number of sites of its orbit
+    :param tol: sites closer than `tol` in the xy plane are the same site
     :param kw:
-    :return:
+    :return: Tuple[ID, position], or Tuple[ID, position, multiplicity] with `symmetry`
     """
-    # default heights
-    h = heights or [(0, 0, i) for i in (0, 2, 1.8, 1.5, 1.3)]
-    tags, layer_pos = get_layers(slab, (0, 0, 1), 0.3)
-    surface_atoms = slab[tags == max(tags)]
-    # n_atoms = len(surface_atoms)
-    atoms = surface_atoms.repeat([3, 3, 1])
-    n_points = len(atoms)
-    # TODO: check if atoms moved
-    atoms.wrap(center=(1/6, 1/6, 0))
-
-    mem = set()
-
-    def memo(pos: Tuple[float, float]) -> bool:
-        label = f'{pos[0]:.2f} {pos[1]:.2f}'
-        res = label in mem
-        if not res:
-            mem.add(label)
-        return res
+    if method not in ('graph', 'combinations'):
+        raise ValueError(f'method "{method}" not recognized.')
+
+    if symmetry:
+        sites = gen_midpoints(slab, cutoff_dist, heights, method, tol=tol, **kw)
+        for ID, pos, multiplicity in gen_unique_sites(slab, sites):
+            logger.info(f'{ID}: multiplicity {multiplicity}')
+            yield (ID, pos, multiplicity)
+        return
+
+    with span('gen_midpoints.setup'):
+        # default heights
+        h = heights or [(0, 0, i) for i in (0, 2, 1.8, 1.5, 1.3)]
+        # sorted, so the site IDs don't depend on the order of the atoms,
+        # e.g. of a POSCAR written with `sort`
+        surface_atoms = surface_layer(slab)
+        # n_atoms = len(surface_atoms)
+        atoms = surface_atoms.repeat([3, 3, 1])
+        n_points = len(atoms)
+        # TODO: check if atoms moved
+        atoms.wrap(center=(1/6, 1/6, 0))
+
+        index = SiteIndex(surface_atoms.cell, tol)
 
     for i, pos in enumerate(surface_atoms.positions):
-        memo(pos)
+        index.memo(pos, f'1_{i}')
+        count('sites_yielded', size=1)
         yield (f'1_{i}', pos + h[1])
 
+    with span('gen_midpoints.setup'):
+        classifier = SiteClassifier(surface_atoms.cell, atoms.positions, cutoff_dist)
+        if method == 'graph':
+            neighbors = neighbor_graph(atoms.positions, cutoff_dist)
+
     for i in range(2, len(h)):
         ix = 0
-        for indices in combinations(range(n_points), i):
-            if not valid_comb(indices, surface_atoms, atoms, cutoff_dist):
-                continue
-            positions = atoms.positions[list(indices)]
-            # TODO:
-            if i == 2:
-                mean = np.mean(positions, axis=0)
-            else:
-                mean = get_incenter(positions[0], positions[1], positions[2])
-            mean += h[i]
-            if not in_cell(surface_atoms, position=mean) or memo(tuple(mean)):
-                continue
-            yield (f'{i}_{ix}', mean)
-            ix += 1
+        if method == 'graph':
+            candidates = gen_cliques(neighbors, i)
+        else:
+            candidates = combinations(range(n_points), i)
+        blocks = gen_blocks(candidates, i)
+        while True:
+            # candidates are enumerated lazily, so the span includes them
+            with span('gen_midpoints.classify', size=i):
+                block = next(blocks, None)
+                if block is None:
+                    break
+                block = block[classifier.valid_comb(block)]
+                # TODO:
+                means = classifier.midpoints(block) + h[i]
+                in_cell = classifier.in_cell(means)
+                if instrumentation.enabled:
+                    count('site_tuples_rejected', len(means) - np.count_nonzero(in_cell),
+                          size=i, reason='midpoint_cell')
+            for mean in means[in_cell]:
+                if index.memo(mean, f'{i}_{ix}'):
+                    count('site_memo_duplicates', size=i)
+                    continue
+                count('sites_yielded', size=i)
+                yield (f'{i}_{ix}', mean)
+                ix += 1
+
+
+def surface_layer(slab: Atoms, decimals: int=4) -> Atoms:
+    """
+    Atoms of the top layer of the slab, sorted by their scaled positions
+    wrapped into the cell, so the same surface gives the same atoms in the
+    same order whatever the order of the atoms of the slab
+    :param slab: Atoms
+    :param decimals: scaled positions are rounded to this many decimals before sorting
+    :return: Atoms
+    """
+    tags, layer_pos = get_layers(slab, (0, 0, 1), 0.3)
+    surface_atoms = slab[tags == max(tags)]
+    # rounding may give 1, which is the same position as 0
+    scaled = np.round(surface_atoms.get_scaled_positions(wrap=True), decimals) % 1
+    return surface_atoms[np.lexsort(scaled.T[::-1])]
+
+
+def surface_key(slab: Atoms, decimals: int=4) -> str:
+    """
+    Hash of the geometry the sites of `gen_midpoints` depend on, i.e. the
+    cell and the positions of the top layer but not its elements.
+    The positions are wrapped into the cell and sorted, so slabs with the
+    same surface have the same key whatever the order of their atoms.
+    Slabs with the same key have the same sites
+    :param slab: Atoms
+    :param decimals: scaled positions and cell are rounded to this many decimals
+    :return: hex digest
+    """
+    surface_atoms = surface_layer(slab, decimals)
+    scaled = np.round(surface_atoms.get_scaled_positions(wrap=True), decimals) % 1
+    h = hashlib.sha1()
+    for array in (surface_atoms.cell[:], scaled):
+        # adding 0 turns negative zeros into zeros
+        h.update(np.ascontiguousarray(np.round(array, decimals) + 0., dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def get_sites(slab: Atoms, cache: Union[SiteCache, str]=None, cutoff_dist: float=3.5,
+              heights: Iterable[float]=None, method: str='graph', symmetry: bool=False,
+              tol: float=0.05) -> List[Tuple[str, np.ndarray]]:
+    """
+    Sites of `gen_midpoints`, read from the cache if a surface with the
+    same `surface_key` was enumerated with the same options before
+    :param slab: Atoms
+    :param cache: SiteCache or the file name of one, sites are always enumerated if None
+    :param symmetry: the cache keeps all the sites, they are reduced afterwards
+    :return: list of (ID, position), or (ID, position, multiplicity) with `symmetry`
+    """
+    if cache is None:
+        return list(gen_midpoints(slab, cutoff_dist, heights, method, symmetry, tol))
+    if isinstance(cache, str):
+        with SiteCache(cache) as cache:
+            return get_sites(slab, cache, cutoff_dist, heights, method, symmetry, tol)
+
+    key = cache.key(surface_key(slab), cutoff_dist=cutoff_dist, heights=heights,
+                    method=method, tol=tol)
+    sites = cache.get(key)
+    if sites is None:
+        count('site_cache', result='miss')
+        sites = list(gen_midpoints(slab, cutoff_dist, heights, method, tol=tol))
+        cache.put(key, sites)
+    else:
+        count('site_cache', result='hit')
+        sites = [(ID, np.array(position)) for ID, position in sites]
+
+    if symmetry:
+        sites = list(gen_unique_sites(slab, sites))
+    return sites
+
+
+def get_site_index(slab: Atoms, tol: float=0.05, cache: Union[SiteCache, str]=None,
+                   **kw) -> SiteIndex:
+    """
+    Returns an index of the sites generated by `gen_midpoints`, e.g. to find
+    the site closest to a relaxed adsorbate
+    :param slab: Atoms
+    :param tol: sites closer than `tol` in the xy plane are the same site
+    :param cache: SiteCache or the file name of one the sites are read from
+    :param kw: gen_midpoints options
+    :return: SiteIndex with the site IDs as keys
+    """
+    index = SiteIndex(slab.cell, tol)
+    for ID, pos, *multiplicity in get_sites(slab, cache, tol=tol, **kw):
+        index.add(pos, ID)
+    return index
 
 
 def center_at_origin(atoms: Atoms) -> Atoms:
@@ -148,7 +422,12 @@ def center_at_origin(atoms: Atoms) -> Atoms:
     if len(ads) == 1:
         ads[0].position = (0, 0, 0)
     else:
-        tags, layer_pos = get_layers(ads, (0, 0, 1), 0.3)
+        if ads.cell.rank < 3:
+            # get_layers needs a cell, e.g. for adsorbates built without one
+            z = ads.positions[:, 2]
+            tags = np.where(z - z.min() < 0.3, 0, 1)
+        else:
+            tags, layer_pos = get_layers(ads, (0, 0, 1), 0.3)
 
         if sum(tags == 0) == 1:
             center = atoms[0].position
@@ -160,6 +439,59 @@ def center_at_origin(atoms: Atoms) -> Atoms:
     return ads
 
 
+def site_multiplicity(multiplicity: list) -> int:
+    """
+    Multiplicity of a site unpacked as `ID, position, *multiplicity`, 1 if it was not given
+    """
+    return multiplicity[0] if multiplicity else 1
+
+
+def gen_placements(atoms: Atoms, adsorbate: Atoms, orientations: Tuple[int, int]=None,
+                   max_polar: float=90., sites: Iterable[Tuple[str, np.ndarray]]=None,
+                   cache: Union[SiteCache, str]=None, **kw) -> Iterator[Tuple[str, Placement]]:
+    """
+    Places the adsorbate on every site without copying the slab,
+    all placements share the same SlabTemplate
+    :param atoms: slab
+    :param adsorbate:
+    :param orientations: (polar, azimuthal) number of angles of the rotations
+        sampled on each site, orientations that clash with the slab are
+        skipped. Upright adsorbate if None
+    :param max_polar: largest tilt of the adsorbate in degrees
+    :param sites: iterable of (ID, position) computed before, e.g. for a slab
+        with the same `surface_key`, gen_midpoints sites if None
+    :param cache: SiteCache or the file name of one the sites are read from
+    :param kw: gen_midpoints options
+    :return: Tuple[ID, Placement]
+    """
+    ads = center_at_origin(adsorbate)
+    template = SlabTemplate(atoms, ads)
+
+    if sites is None:
+        sites = gen_midpoints(atoms, **kw) if cache is None else get_sites(atoms, cache, **kw)
+    elif kw.get('symmetry'):
+        # the elements of the slab may lower the symmetry of the shared sites
+        sites = gen_unique_sites(atoms, ((ID, pos) for ID, pos, *_ in sites))
+
+    if orientations is None:
+        for ID, point, *multiplicity in sites:
+            yield (ID, template.place(point, ID, multiplicity=site_multiplicity(multiplicity)))
+        return
+
+    n_polar, n_azimuthal = orientations
+    n_spin = 1 if is_linear(ads) else n_azimuthal
+    rotations = rotation_grid(n_polar, n_azimuthal, max_polar, n_spin)
+    checker = ClashChecker(atoms)
+    for ID, point, *multiplicity in sites:
+        with span('gen_placements.clashes'):
+            poses = list(gen_poses(checker, ads, point, rotations))
+        count('poses_rejected', len(rotations) - len(poses))
+        for k, rotation in poses:
+            pose_ID = f'{ID}_r{k}'
+            yield (pose_ID, template.place(point, pose_ID, rotation,
+                                           site_multiplicity(multiplicity)))
+
+
 def gen_structs(atoms: Atoms, adsorbate: Atoms, **kw) -> Iterator[Tuple[str, Atoms]]:
     """
 
@@ -168,13 +500,8 @@ def gen_structs(atoms: Atoms, adsorbate: Atoms, **kw) -> Iterator[Tuple[str, Ato
     :param kw:
     :return: Tuple[ID, atoms + adsorbate]
     """
-    # TODO: orient/rotate
-    ads = center_at_origin(adsorbate)
-
-    for ID, point in gen_midpoints(atoms, **kw):
-        a = ads.copy()
-        a.translate(point)
-        a.set_scaled_positions(point)
-        slab_ads = atoms + a
+    for ID, placement in gen_placements(atoms, adsorbate, **kw):
+        with span('gen_structs.assemble'):
+            slab_ads = placement.to_atoms()
         yield (ID,  slab_ads)
 
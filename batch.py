@@ -0,0 +1,172 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from os import chdir, makedirs, path
+from typing import Iterable, List
+
+from ase.io import read
+
+from auto import get_sites, surface_key
+from curlywaddle import get_adsorbate, run_all, write_all
+from reader import read_config
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+SLAB_PATTERNS = ('*.vasp', 'POSCAR*', 'CONTCAR*', '*.traj', '*.cif', '*.xyz')
+# gen_jobs options of the sites, see `auto.gen_midpoints`
+SITE_OPTIONS = ('cutoff_dist', 'heights', 'method', 'tol')
+
+
+def find_slabs(sources: Iterable[str]) -> List[str]:
+    """
+    Slab files of a batch
+    :param sources: directories, glob patterns, files or text files listing
+        one slab per line (`.txt` or `.list`, `#` starts a comment)
+    :return: sorted list of absolute paths without duplicates
+    """
+    slabs = set()
+    for source in sources:
+        if path.isdir(source):
+            for pattern in SLAB_PATTERNS:
+                slabs.update(glob(path.join(source, pattern)))
+        elif source.endswith(('.txt', '.list')) and path.isfile(source):
+            directory = path.dirname(source)
+            with open(source) as f:
+                for line in f:
+                    line = line.split('#')[0].strip()
+                    if line:
+                        slabs.add(path.join(directory, line))
+        elif path.isfile(source):
+            slabs.add(source)
+        else:
+            matches = glob(source)
+            if not matches:
+                logger.warning(f'{source}: no slab found')
+            slabs.update(matches)
+    return sorted(path.abspath(slab) for slab in slabs if path.isfile(slab))
+
+
+def campaign_names(slabs: List[str]) -> List[str]:
+    """
+    Name of the directory of each campaign, the name of the slab file
+    without extension, prefixed by its directory if two slabs have the same name
+    """
+    names = [path.splitext(path.basename(slab))[0] or path.basename(slab) for slab in slabs]
+    return [f'{path.basename(path.dirname(slab))}_{name}' if names.count(name) > 1 else name
+            for slab, name in zip(slabs, names)]
+
+
+def compute_sites(slab: str, fmt: str=None, cache: str=None, **kw) -> list:
+    """
+    Sites of a slab, run in a worker of the pool
+    :param cache: file name of the SiteCache
+    :param kw: gen_midpoints options, see `SITE_OPTIONS`
+    :return: list of (ID, position)
+    """
+    return get_sites(read(slab, format=fmt), cache, **kw)
+
+
+def run_campaign(task: dict) -> dict:
+    """
+    Generates or submits the jobs of one slab in its own directory,
+    run in a worker of the pool
+    :param task: Dict with the slab, the campaign options and the shared sites
+    :return: Dict with the state of the campaign
+    """
+    result = dict(slab=task['slab'], directory=task['directory'],
+                  surface=task['surface'], state=None, error=None)
+    try:
+        slab = read(task['slab'], format=task['format'])
+        adsorbate = get_adsorbate(task['ads'])
+        config = read_config(task['config']) if task['config'] else dict()
+
+        makedirs(task['directory'], exist_ok=True)
+        # each worker is a separate process, changing its directory is safe
+        chdir(task['directory'])
+        opts = dict(task['opts'])
+        if task['sites'] is not None:
+            opts['sites'] = task['sites']
+            opts.pop('cache', None)
+        if task['poscar_only']:
+            result['state'] = write_all(slab, adsorbate, config, **opts)
+        else:
+            result['state'] = run_all(slab, adsorbate, config, max_workers=task['jobs'],
+                                      rate=task['rate'], **opts)
+    except Exception as e:
+        logger.error(f'{task["slab"]}: {e}')
+        result['error'] = f'{type(e).__name__}: {e}'
+    return result
+
+
+def run_batch(slabs: List[str], ads: str='O', config: str=None, fmt: str=None,
+              output: str='.', poscar_only: bool=False, processes: int=None,
+              jobs: int=4, rate: float=None, **opts) -> List[dict]:
+    """
+    Runs the campaign of every slab on a process pool, each one in
+    `output/<slab name>`. Sites are computed once per distinct surface
+    geometry and shared by the slabs with the same `surface_key`
+    :param slabs: slab files
+    :param ads: adsorbate name, see `get_adsorbate`
+    :param config: configuration file, required unless `poscar_only`
+    :param fmt: format of the slab files, guessed by ASE if None
+    :param output: directory of the campaigns
+    :param poscar_only: write the POSCARs only
+    :param processes: size of the pool, number of CPUs if None
+    :param jobs: maximum number of concurrent submissions of each campaign
+    :param rate: maximum number of submissions per second of each campaign
+    :param opts: gen_jobs options
+    :return: list with the state of each campaign
+    """
+    config = path.abspath(config) if config else None
+    if isinstance(opts.get('cache'), str):
+        # the campaigns run in their own directory but share the cache
+        opts['cache'] = path.abspath(opts['cache'])
+    # coverages complete the site list with the symmetry of each slab
+    share_sites = not opts.get('coverage')
+
+    surfaces = dict()
+    for slab in slabs:
+        surfaces[slab] = surface_key(read(slab, format=fmt))
+    representatives = dict()
+    for slab, key in surfaces.items():
+        representatives.setdefault(key, slab)
+    logger.info(f'{len(slabs)} slabs, {len(representatives)} distinct surfaces')
+
+    with ProcessPoolExecutor(processes) as pool:
+        sites = dict()
+        if share_sites:
+            site_opts = {name: opts[name] for name in SITE_OPTIONS if name in opts}
+            futures = {key: pool.submit(compute_sites, slab, fmt, opts.get('cache'),
+                                        **site_opts)
+                       for key, slab in representatives.items()}
+            sites = {key: future.result() for key, future in futures.items()}
+
+        tasks = [dict(slab=slab, format=fmt, ads=ads, config=config,
+                      directory=path.abspath(path.join(output, name)),
+                      surface=surfaces[slab][:8], sites=sites.get(surfaces[slab]),
+                      poscar_only=poscar_only, jobs=jobs, rate=rate, opts=opts)
+                 for slab, name in zip(slabs, campaign_names(slabs))]
+        return list(pool.map(run_campaign, tasks))
+
+
+def format_report(results: List[dict]) -> str:
+    """
+    Aggregated report of the campaigns run by `run_batch`
+    """
+    lines = []
+    for result in results:
+        name = path.basename(result['directory'])
+        state = f'FAILED {result["error"]}' if result['error'] else result['state']
+        lines.append(f'{name:30} {result["surface"]:8} {state}')
+    n_failed = sum(1 for result in results if result['error'])
+    n_surfaces = len({result['surface'] for result in results})
+    lines.append(f'{len(results)} campaigns on {n_surfaces} distinct surfaces, '
+                 f'{n_failed} failed')
+    return '\n'.join(lines)
+
+
+def write_report(results: List[dict], fname: str):
+    with open(fname, 'w') as f:
+        json.dump(results, f, indent=1)
@@ -0,0 +1,233 @@
+#!/bin/env python
+
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from glob import glob
+from os import chdir, getcwd, path
+from unittest import mock
+
+import ase
+import numpy as np
+from ase.atoms import Atoms
+from ase.build import fcc100, fcc111
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import auto
+from auto import gen_midpoints, gen_placements, gen_structs
+from curlywaddle import write_all
+from generate_inputs import adsorb_on_all
+
+# times site enumeration, structure assembly and writing on synthetic slabs,
+# results are written as JSON to compare them between commits
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def bimetallic(size, a=3.84) -> Atoms:
+    """
+    fcc(111) slab with every other atom replaced by Cu
+    """
+    slab = fcc111('Pt', size, a=a, vacuum=10.)
+    slab.symbols[::2] = 'Cu'
+    return slab
+
+
+SURFACES = {'Pt111': lambda size: fcc111('Pt', size, vacuum=10.),
+            'Pt100': lambda size: fcc100('Pt', size, vacuum=10.),
+            'PtCu111': bimetallic}
+SIZES = {'quick': [(2, 2, 3)],
+         'default': [(2, 2, 3), (3, 3, 3), (4, 4, 3)]}
+CUTOFFS = {'quick': [3.5],
+           'default': [3.0, 3.5]}
+
+
+def measure(func, repeat: int=3) -> dict:
+    """
+    Best wall time of `func` over `repeat` runs and peak memory of an extra
+    run, tracemalloc slows down the run so it is not timed
+    :return: Dict[seconds, peak_mb, result]
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(seconds=min(times), peak_mb=peak / 2**20, result=result)
+
+
+@contextlib.contextmanager
+def scratch_dir():
+    cwd = getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        chdir(directory)
+        try:
+            yield directory
+        finally:
+            chdir(cwd)
+
+
+def bench_enumeration(slab, cutoff, repeat):
+    res = measure(lambda: len(list(gen_midpoints(slab, cutoff))), repeat)
+    return dict(stage='enumeration', seconds=res['seconds'], peak_mb=res['peak_mb'],
+                sites=res['result'], sites_per_s=res['result'] / res['seconds'])
+
+
+def bench_adsorb_on_all(slab, cutoff, repeat):
+    ads = Atoms('O')
+
+    def run():
+        # every run writes to a fresh directory so no file is skipped
+        with scratch_dir(), contextlib.redirect_stdout(io.StringIO()):
+            adsorb_on_all(slab, ads, cutoff, manifest=':memory:')
+            return len(glob('POSCAR_*'))
+
+    res = measure(run, repeat)
+    return dict(stage='adsorb_on_all', seconds=res['seconds'], peak_mb=res['peak_mb'],
+                sites=res['result'], sites_per_s=res['result'] / res['seconds'])
+
+
+def bench_assembly(slab, cutoff, repeat):
+    ads = Atoms('O')
+    sites = list(gen_midpoints(slab, cutoff))
+    # the sites are enumerated once so only the assembly is timed
+    with mock.patch.object(auto, 'gen_midpoints', lambda *args, **kw: iter(sites)):
+        res = measure(lambda: len(list(gen_structs(slab, ads, cutoff_dist=cutoff))), repeat)
+    return dict(stage='assembly', seconds=res['seconds'], peak_mb=res['peak_mb'],
+                sites=res['result'], sites_per_s=res['result'] / res['seconds'])
+
+
+def bench_placement(slab, cutoff, repeat):
+    ads = Atoms('O')
+    sites = list(gen_midpoints(slab, cutoff))
+
+    def run():
+        # placements are consumed as they are streamed, like write_all does
+        n = 0
+        for ID, placement in gen_placements(slab, ads, cutoff_dist=cutoff):
+            placement.adsorbate_positions
+            n += 1
+        return n
+
+    with mock.patch.object(auto, 'gen_midpoints', lambda *args, **kw: iter(sites)):
+        res = measure(run, repeat)
+    return dict(stage='placement', seconds=res['seconds'], peak_mb=res['peak_mb'],
+                sites=res['result'], sites_per_s=res['result'] / res['seconds'])
+
+
+def bench_writing(slab, cutoff, repeat):
+    ads = Atoms('O')
+    sites = len(list(gen_midpoints(slab, cutoff)))
+
+    def run():
+        with scratch_dir():
+            return write_all(slab, ads, cutoff_dist=cutoff)
+
+    res = measure(run, repeat)
+    return dict(stage='write_all', seconds=res['seconds'], peak_mb=res['peak_mb'],
+                sites=sites, sites_per_s=sites / res['seconds'])
+
+
+STAGES = {'enumeration': bench_enumeration,
+          'adsorb_on_all': bench_adsorb_on_all,
+          'assembly': bench_assembly,
+          'placement': bench_placement,
+          'write_all': bench_writing}
+
+
+def git_commit() -> str:
+    proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                          capture_output=True, text=True)
+    return proc.stdout.strip() or None
+
+
+def compare(results: list, reference: list, threshold: float) -> list:
+    """
+    :return: List[(name, ratio)] of the cases slower than `threshold` times the reference
+    """
+    def key(res):
+        return (res['surface'], tuple(res['size']), res['cutoff'], res['stage'])
+
+    reference = {key(res): res for res in reference}
+    slower = []
+    for res in results:
+        ref = reference.get(key(res))
+        if ref is None:
+            continue
+        ratio = res['seconds'] / ref['seconds']
+        if ratio > threshold:
+            slower.append((' '.join(map(str, key(res))), ratio))
+    return slower
+
+
+def get_args(argv=''):
+    parser = ArgumentParser()
+    parser.add_argument('-o', '--output', default='generation.json',
+                        help='JSON file to write the results to')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true',
+                        help='only the smallest slab and default cutoff')
+    parser.add_argument('--surfaces', nargs='+', choices=list(SURFACES),
+                        default=list(SURFACES))
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES),
+                        default=list(STAGES))
+    parser.add_argument('--compare',
+                        help='JSON file of a previous run, exits with 1 if any case is slower')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio considered a regression')
+    if isinstance(argv, str):
+        argv = argv.split() or None
+    return parser.parse_args(argv)
+
+
+def main(argv=''):
+    args = get_args(argv)
+    preset = 'quick' if args.quick else 'default'
+
+    results = []
+    for surface in args.surfaces:
+        for size in SIZES[preset]:
+            slab = SURFACES[surface](size)
+            for cutoff in CUTOFFS[preset]:
+                for stage in args.stages:
+                    res = STAGES[stage](slab, cutoff, args.repeat)
+                    res.update(surface=surface, size=list(size), cutoff=cutoff)
+                    results.append(res)
+                    print(f'{surface:8} {"x".join(map(str, size)):6} {cutoff:4} '
+                          f'{stage:14} {res["sites"]:6} sites {res["seconds"]:9.4f} s '
+                          f'{res["sites_per_s"]:10.0f} sites/s {res["peak_mb"]:8.2f} MB')
+
+    report = dict(commit=git_commit(),
+                  python=platform.python_version(),
+                  numpy=np.__version__,
+                  ase=ase.__version__,
+                  repeat=args.repeat,
+                  results=results)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        slower = compare(results, reference['results'], args.threshold)
+        for name, ratio in slower:
+            print(f'{name}: {ratio:.2f}x slower than {reference["commit"]}')
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+#!/bin/env python
+
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from os import path
+
+# guards the start up time of the command line interface: the light
+# subcommands must not import the heavy modules
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+HEAVY_MODULES = ('numpy', 'ase', 'matplotlib', 'vasp', 'scipy')
+# command -> (arguments, heavy modules it must not import)
+LIGHT_COMMANDS = {'status': (['status', '-m', 'jobs.sqlite'], HEAVY_MODULES),
+                  'help': (['--help'], HEAVY_MODULES),
+                  # the convergence search needs numpy and ase, not the plots nor the calculator
+                  'converge': (['converge', '--help'], ('matplotlib', 'vasp', 'scipy'))}
+
+
+def imported_modules(argv, cwd) -> set:
+    """
+    Top level modules imported when running the command line interface with `argv`
+    """
+    cmd = [sys.executable, '-X', 'importtime', path.join(ROOT, 'cli.py')] + argv
+    proc = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True)
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            name = line.rsplit('|', 1)[1].strip()
+            modules.add(name.split('.')[0])
+    return modules
+
+
+def wall_time(argv, cwd, repeat: int=5) -> float:
+    """
+    Best wall time of running the command line interface with `argv`
+    """
+    cmd = [sys.executable, path.join(ROOT, 'cli.py')] + argv
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=cwd, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def get_args(argv=''):
+    parser = ArgumentParser()
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help='maximum wall time of a light command in seconds')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-o', '--output', help='JSON file to write the results to')
+    if isinstance(argv, str):
+        argv = argv.split() or None
+    return parser.parse_args(argv)
+
+
+def main(argv=''):
+    args = get_args(argv)
+
+    results = dict()
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, (cmd, forbidden) in LIGHT_COMMANDS.items():
+            heavy = sorted(set(forbidden) & imported_modules(cmd, cwd))
+            seconds = wall_time(cmd, cwd, args.repeat)
+            ok = not heavy and seconds < args.budget
+            failed |= not ok
+            results[name] = dict(seconds=seconds, heavy_modules=heavy, ok=ok)
+            print(f'{name:10} {seconds:8.3f} s  {"ok" if ok else "FAILED"}'
+                  + (f'  imports {", ".join(heavy)}' if heavy else ''))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,22 @@
 #!/bin/env python
 
+import csv
+import json
+import sqlite3
 from argparse import ArgumentParser
-from os import path, listdir
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import cpu_count, path, listdir, stat
+from typing import Dict, Iterable, List, Tuple
 
 import numpy as np
-from ase.geometry import distance
+from ase.atoms import Atoms
+from ase.geometry import distance, find_mic
 from ase.io import read
 
+from auto import get_site_index, surface_key
+from sites import SiteIndex
+
 
 def atom_distance(a0, a1):
     xy0 = a0.position[:2]
@@ -14,20 +24,292 @@ def atom_distance(a0, a1):
     return np.linalg.norm(xy1 - xy0)
 
 
+def displacements(initial: Atoms, final: Atoms) -> np.ndarray:
+    """
+    Displacement of every atom using the minimum image convention,
+    atoms that crossed the cell boundary are not counted as moved a full cell
+    :param initial: Atoms
+    :param final: Atoms with the same atoms in the same order
+    :return: (n, 3) array
+    """
+    vectors, lengths = find_mic(final.positions - initial.positions, initial.cell, initial.pbc)
+    return vectors
+
+
+def heights(atoms: Atoms) -> np.ndarray:
+    """
+    Scaled z coordinates measured from the top of the vacuum, adsorbates
+    written at the top of the cell may be wrapped to the bottom
+    """
+    z = atoms.get_scaled_positions()[:, 2]
+    ordered = np.sort(z)
+    gaps = np.diff(np.append(ordered, ordered[0] + 1))
+    bottom = ordered[(np.argmax(gaps) + 1) % len(ordered)]
+    return (z - bottom) % 1
+
+
+def adsorbate_indices(atoms: Atoms, symbols: Iterable[str]=None) -> np.ndarray:
+    """
+    Indices of the adsorbate atoms, POSCARs are sorted by element so the
+    adsorbate is not at the end
+    :param atoms: Atoms of slab + adsorbate
+    :param symbols: elements of the adsorbate, if None the elements with
+        no atom in the lower half of the structure
+    :return: array of indices
+    """
+    atom_symbols = np.array(atoms.get_chemical_symbols())
+    if symbols is None:
+        z = heights(atoms)
+        lower = set(atom_symbols[z < z.max() / 2])
+        symbols = set(atom_symbols) - lower
+    return np.nonzero(np.isin(atom_symbols, list(symbols)))[0]
+
+
+def anchor_indices(atoms: Atoms, adsorbate: np.ndarray) -> np.ndarray:
+    """
+    Adsorbate atoms that bind to the surface, the atoms with the element of
+    the lowest adsorbate atom, e.g. the O of each OH
+    """
+    if not len(adsorbate):
+        return adsorbate
+    lowest = adsorbate[np.argmin(heights(atoms)[adsorbate])]
+    return adsorbate[atoms.numbers[adsorbate] == atoms.numbers[lowest]]
+
+
+def analyze(poscar: Atoms, contcar: Atoms, indexes: Dict[str, SiteIndex],
+            symbols: Iterable[str]=None, **kw) -> dict:
+    """
+    Displacement of each atom and adsorption site of each adsorbate before and after a relaxation
+    :param poscar: Atoms before the relaxation
+    :param contcar: Atoms after the relaxation
+    :param indexes: site indexes of the surfaces seen before, keyed by `surface_key`,
+        the index of a new surface is added
+    :param symbols: elements of the adsorbate, see `adsorbate_indices`
+    :param kw: get_site_index options
+    :return: Dict with the displacement of each atom, the anchor atoms,
+        their initial and final sites and the surface key
+    """
+    d = np.linalg.norm(displacements(poscar, contcar), axis=1)
+    adsorbate = adsorbate_indices(poscar, symbols)
+    anchors = anchor_indices(poscar, adsorbate)
+    slab = poscar[np.setdiff1d(np.arange(len(poscar)), adsorbate)]
+
+    key = surface_key(slab)
+    if key not in indexes:
+        indexes[key] = get_site_index(slab, **kw)
+    index = indexes[key]
+    initial, _ = index.nearest_all(poscar.positions[anchors])
+    final, offsets = index.nearest_all(contcar.positions[anchors])
+    return dict(displacements=d, anchors=anchors,
+                symbols=[poscar[i].symbol for i in anchors], initial=initial, final=final,
+                offsets=offsets, surface=key,
+                migrated=[i for i, (s0, s1) in enumerate(zip(initial, final)) if s0 != s1])
+
+
+def has_outputs(name: str) -> bool:
+    """
+    Whether the job has a POSCAR and a non-empty CONTCAR, i.e. it can be checked
+    """
+    contcar = path.join(name, 'CONTCAR')
+    return path.isfile(path.join(name, 'POSCAR')) and path.isfile(contcar) \
+        and path.getsize(contcar) > 0
+
+
+def check_job(name: str, xy: str=None, sites: bool=False, symbols: Iterable[str]=None,
+              site_cache: str=None, indexes: Dict[str, SiteIndex]=None) -> dict:
+    """
+    Compares the POSCAR and CONTCAR of a job
+    :param name: directory of the job
+    :param xy: distance in the x and y axis of the first atom of this element,
+        `ase.geometry.distance` if None
+    :param sites: map the adsorbates to their sites, see `analyze`
+    :param symbols: elements of the adsorbate
+    :param site_cache: file name of the SiteCache
+    :param indexes: site indexes of the surfaces seen before, see `analyze`
+    :return: Dict that can be written as JSON
+    """
+    # get atoms object from POSCAR
+    poscar = read(path.join(name, 'POSCAR'))
+    # get atoms object from CONTCAR
+    contcar = read(path.join(name, 'CONTCAR'))
+
+    if xy:
+        # get the first atom whose symbol == xy
+        a0 = next(a for a in poscar if a.symbol == xy)
+        a1 = next(a for a in contcar if a.symbol == xy)
+        d = atom_distance(a0, a1)
+    else:
+        d = distance(poscar, contcar)
+    result = dict(name=name, distance=float(d))
+    if sites:
+        indexes = dict() if indexes is None else indexes
+        analysis = analyze(poscar, contcar, indexes, symbols, cache=site_cache)
+        result.update(displacements=analysis['displacements'].tolist(),
+                      anchors=analysis['anchors'].tolist(),
+                      offsets=analysis['offsets'].tolist(),
+                      symbols=analysis['symbols'], initial=analysis['initial'],
+                      final=analysis['final'], surface=analysis['surface'],
+                      migrated=analysis['migrated'])
+    return result
+
+
+# site indexes of the surfaces seen by a worker process of the scan, see `init_worker`
+_worker_indexes = None
+
+
+def init_worker():
+    global _worker_indexes
+    _worker_indexes = dict()
+
+
+def check_in_worker(name: str, **options) -> dict:
+    """
+    `check_job` in a worker of the scan, the site indexes are shared by the jobs of the worker
+    """
+    return check_job(name, indexes=_worker_indexes, **options)
+
+
+class ScanCache:
+    """
+    Results of the jobs checked before, keyed by directory.
+    A job is checked again when the size or modification time of its
+    POSCAR or CONTCAR changed, or when it is checked with other options
+    """
+    def __init__(self, fname: str='check.sqlite'):
+        self.connection = sqlite3.connect(fname)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                '(name TEXT PRIMARY KEY, stamp TEXT, data TEXT)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    @staticmethod
+    def stamp(name: str, options: dict) -> str:
+        """
+        Size and modification time of the files of a job and the options it is checked with
+        """
+        files = []
+        for fname in ('POSCAR', 'CONTCAR'):
+            st = stat(path.join(name, fname))
+            files.append((st.st_size, st.st_mtime_ns))
+        return json.dumps(dict(files=files, **options), sort_keys=True)
+
+    def results(self) -> Dict[str, Tuple[str, str]]:
+        """
+        :return: Dict[name, (stamp, result as JSON)]
+        """
+        rows = self.connection.execute('SELECT name, stamp, data FROM results')
+        return {name: (stamp, data) for name, stamp, data in rows}
+
+    def put(self, name: str, stamp: str, result: dict):
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                                (name, stamp, json.dumps(result)))
+
+
+def scan(names: List[str], processes: int=None, cache: str=None, **options) -> List[dict]:
+    """
+    Checks the jobs on a process pool, jobs whose files didn't change are read from the cache.
+    Jobs without outputs yet, see `has_outputs`, are skipped
+    :param names: directories of the jobs
+    :param processes: size of the pool, number of CPUs if None
+    :param cache: file name of the ScanCache, nothing is cached if None
+    :param options: check_job options
+    :return: list with the result of each job with outputs, in the order of `names`
+    """
+    names = [name for name in names if has_outputs(name)]
+    processes = processes or cpu_count()
+    results = dict()
+    stale = names
+    if cache:
+        scan_cache = ScanCache(cache)
+        cached = scan_cache.results()
+        stamps = {name: ScanCache.stamp(name, options) for name in names}
+        stale = []
+        for name in names:
+            stamp, data = cached.get(name, (None, None))
+            if stamp == stamps[name]:
+                results[name] = json.loads(data)
+            else:
+                stale.append(name)
+
+    try:
+        if stale:
+            with ProcessPoolExecutor(processes, initializer=init_worker) as pool:
+                # large chunks, parsing a job takes a few milliseconds
+                chunksize = max(1, len(stale) // (4 * processes))
+                checked = pool.map(partial(check_in_worker, **options), stale,
+                                   chunksize=chunksize)
+                for name, result in zip(stale, checked):
+                    results[name] = result
+                    if cache:
+                        scan_cache.put(name, stamps[name], result)
+    finally:
+        if cache:
+            scan_cache.close()
+    return [results[name] for name in names]
+
+
+def write_table(results: List[dict], fname: str, threshold: float=0.001):
+    """
+    Writes one row per job, JSON if `fname` ends with .json, CSV otherwise
+    """
+    rows = []
+    for result in results:
+        row = dict(name=result['name'], distance=result['distance'])
+        if 'displacements' in result:
+            d = np.array(result['displacements'])
+            row.update(max_displacement=float(d.max()) if len(d) else 0.,
+                       moved_atoms=int(np.count_nonzero(d > threshold)),
+                       initial_sites=' '.join(result['initial']),
+                       final_sites=' '.join(result['final']),
+                       migrated=bool(result['migrated']),
+                       same_sites_as=result.get('same_sites_as'))
+        rows.append(row)
+
+    with open(fname, 'w', newline='') as f:
+        if fname.endswith('.json'):
+            json.dump(rows, f, indent=1)
+        elif rows:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
 def get_args(argv=''):
     parser = ArgumentParser()
     parser.add_argument('-a', '--all', action='store_true')
     parser.add_argument('--xy',
                         help='distance in the x and y axis of the given element')
-    if argv:
-        if isinstance(argv, str):
-            argv = argv.split()
-        elif not hasattr(argv, '__iter__'):
-            raise TypeError(f'argv must be `str` or iterable, not {type(argv)}')
-        args = parser.parse_args(argv)
-    else:
-        # get arguments from terminal
-        args = parser.parse_args()
+    parser.add_argument('-s', '--sites', action='store_true',
+                        help='find the adsorbates that moved to another site and '
+                             'the jobs that relaxed to the same sites')
+    parser.add_argument('--ads', nargs='+',
+                        help='elements of the adsorbate, '
+                             'elements only found in the top half of the slab if not given')
+    parser.add_argument('--site-cache',
+                        help='read the sites of the surfaces from this cache')
+    parser.add_argument('-n', '--processes', type=int,
+                        help='number of jobs checked at once')
+    parser.add_argument('--cache', default='check.sqlite',
+                        help='results of the jobs checked before, '
+                             'only jobs whose POSCAR or CONTCAR changed are read again')
+    parser.add_argument('--no-cache', dest='cache', action='store_const', const=None)
+    parser.add_argument('-o', '--output',
+                        help='write a table with one row per job, JSON if it ends with .json, '
+                             'CSV otherwise')
+    if isinstance(argv, str):
+        # get arguments from terminal if empty
+        argv = argv.split() or None
+    elif not hasattr(argv, '__iter__'):
+        raise TypeError(f'argv must be `str` or iterable, not {type(argv)}')
+    args = parser.parse_args(argv)
 
     return args
 
@@ -35,34 +317,51 @@ def get_args(argv=''):
 def main(argv='', threshold=0.001):
     args = get_args(argv)
 
-    distances = dict()
+    names = [name for name in sorted(listdir('.')) if path.isdir(name)]
+    options = dict(xy=args.xy)
+    if args.sites:
+        options.update(sites=True, symbols=args.ads, site_cache=args.site_cache)
+    results = scan(names, args.processes, args.cache, **options)
+
+    checked = {result['name'] for result in results}
+    pending = [name for name in names if name not in checked]
+    if pending:
+        print(f'pending jobs (no CONTCAR): {" ".join(pending)}')
+
     print('incorrect structures:')
-    for name in listdir('.'):
-        if not path.isdir(name):
-            continue
-        # get atoms object from POSCAR
-        poscar_path = path.join(name, 'POSCAR')
-        poscar = read(poscar_path)
-        # get atoms object from CONTCAR
-        contcar_path = path.join(name, 'CONTCAR')
-        contcar = read(contcar_path)
-
-        if args.xy:
-            # get the first atom whose symbol == args.xy
-            a0 = next(a for a in poscar if a.symbol == args.xy)
-            a1 = next(a for a in contcar if a.symbol == args.xy)
-            d = atom_distance(a0, a1)
-        else:
-            d = distance(poscar, contcar)
-        #
+    for result in results:
+        d = result['distance']
         if d > threshold:
-            print(f'{name+":":11} {d:11.3f}')
-        distances[name] = d
+            print(f'{result["name"]+":":11} {d:11.3f}')
+
+    if args.sites:
+        print('migrated adsorbates:')
+        for result in results:
+            d = np.array(result['displacements'])
+            moved = np.nonzero(d > threshold)[0]
+            for i in result['migrated']:
+                print(f'{result["name"]+":":11} {result["symbols"][i]}{result["anchors"][i]} '
+                      f'{result["initial"][i]} -> {result["final"][i]} '
+                      f'({result["offsets"][i]:.3f} from the site, '
+                      f'{len(moved)} atoms moved, largest {d.max():.3f})')
+
+        print('same final sites as:')
+        seen = dict()
+        for result in results:
+            config = (result['surface'], tuple(sorted(zip(result['symbols'], result['final']))))
+            if config in seen:
+                result['same_sites_as'] = seen[config]
+                print(f'{result["name"]+":":11} {seen[config]}')
+            else:
+                seen[config] = result['name']
 
     if args.all:
         print('all distances:')
-        for name, d in distances.items():
-            print(f'{name+":":11} {d:11.6f}')
+        for result in results:
+            print(f'{result["name"]+":":11} {result["distance"]:11.6f}')
+
+    if args.output:
+        write_table(results, args.output, threshold)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,229 @@
+#!/bin/env python
+
+import logging
+import sys
+from argparse import ArgumentParser
+from os import path
+
+import instrumentation
+from reader import add_campaign_arguments, add_job_arguments, setup_logging
+
+# heavy modules (ase, numpy, vasp, matplotlib) are imported by the
+# subcommand that needs them, so that e.g. `status` starts fast
+
+logger = logging.getLogger('curlywaddle')
+
+
+def generate(args):
+    from curlywaddle import load_campaign, write_all
+
+    slab, adsorbate, config, opts = load_campaign(args)
+    return write_all(slab, adsorbate, config, archive=args.archive,
+                     manifest=args.manifest, **opts)
+
+
+def submit(args):
+    from curlywaddle import load_campaign, run_all
+
+    assert path.isfile(args.config), f'config: `{args.config}` must be an existing file'
+    slab, adsorbate, config, opts = load_campaign(args)
+    archive = args.archive if args.archive and path.isfile(args.archive) else None
+    return run_all(slab, adsorbate, config, archive=archive,
+                   max_workers=args.jobs, rate=args.rate,
+                   manifest=args.manifest, **opts)
+
+
+def status(args):
+    from manifest import batch_status, job_status
+
+    if args.batch:
+        return batch_status(args.batch, args.manifest)
+    return job_status(args.manifest)
+
+
+def batch(args):
+    from batch import find_slabs, format_report, run_batch, write_report
+    from curlywaddle import campaign_options
+
+    slabs = find_slabs(args.sources)
+    if not slabs:
+        return 'no slabs found'
+    if not args.poscar_only:
+        assert path.isfile(args.config), f'config: `{args.config}` must be an existing file'
+    config = args.config if path.isfile(args.config) else None
+    results = run_batch(slabs, args.ads, config, args.format, args.output,
+                        args.poscar_only, args.processes, args.jobs, args.rate,
+                        **campaign_options(args))
+    if args.report:
+        write_report(results, args.report)
+    return format_report(results)
+
+
+def watch(args):
+    from reader import read_config
+    from watcher import AdsorptionEnergies, SinglePoint, watch
+
+    stages = []
+    if args.single_point:
+        assert path.isfile(args.config), f'config: `{args.config}` must be an existing file'
+        stages.append(SinglePoint(read_config(args.config)))
+    if args.slab_energy is not None:
+        stage = 'single_point' if args.single_point else None
+        stages.append(AdsorptionEnergies(args.slab_energy, args.reference_energy, stage=stage))
+    return watch(args.manifest, stages, args.interval, args.max_concurrent, args.timeout)
+
+
+def results(args):
+    from os import listdir
+    from outcar import format_results, read_results
+
+    directories = args.directories
+    if not directories and path.isfile(args.manifest):
+        from manifest import JobManifest
+
+        # job IDs are their directories, e.g. `1_0/encut520` with swept settings
+        with JobManifest(args.manifest) as manifest:
+            directories = [job['id'] for job in manifest.jobs()]
+    if not directories:
+        directories = sorted(name for name in listdir('.') if path.isdir(name))
+    return '\n'.join(format_results(directory, read_results(directory))
+                     for directory in directories)
+
+
+def check(args):
+    from check_distance import main
+
+    main(args.argv)
+
+
+def converge(args):
+    from optimize_parameters import main
+
+    main(args.argv)
+
+
+def relax(args):
+    from ase.io import read
+    from reader import Sweep, read_config
+    from relax_structure import relax_struct
+
+    atoms = read(args.structure, format=args.format)
+    config = read_config(args.config)
+    assert not any(isinstance(value, Sweep) for value in config.values()), \
+        f'config: `{args.config}` sweeps settings, relax needs a single value of each'
+    calculator = None if args.pre_relax == 'none' else args.pre_relax
+    return relax_struct(atoms, config, calculator=calculator,
+                        low_precision=not args.no_low_precision)
+
+
+def get_args(argv=''):
+    parser = ArgumentParser(prog='curlywaddle')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='write the POSCAR of all jobs')
+    add_campaign_arguments(generate_parser)
+    generate_parser.set_defaults(func=generate, logs=True)
+
+    submit_parser = subparsers.add_parser('submit', help='submit all jobs')
+    add_campaign_arguments(submit_parser)
+    submit_parser.set_defaults(func=submit, logs=True)
+
+    status_parser = subparsers.add_parser('status', help='number of finished jobs')
+    status_parser.add_argument('-m', '--manifest', default='jobs.sqlite',
+                               help='job manifest of the campaign')
+    status_parser.add_argument('-b', '--batch', metavar='DIRECTORY',
+                               help='status of every campaign in DIRECTORY')
+    status_parser.set_defaults(func=status, logs=False)
+
+    batch_parser = subparsers.add_parser('batch', help='generate or submit the jobs of many slabs')
+    batch_parser.add_argument('sources', nargs='+',
+                              help='slab files, directories, glob patterns or '
+                                   '.txt files listing one slab per line')
+    batch_parser.add_argument('--ads', default='O', choices=['O', 'OH'])
+    add_job_arguments(batch_parser)
+    batch_parser.add_argument('-p', '--poscar_only', action='store_true',
+                              help='writes POSCAR only, does not run')
+    batch_parser.add_argument('-o', '--output', default='.',
+                              help='directory of the campaigns, one subdirectory per slab')
+    batch_parser.add_argument('-n', '--processes', type=int,
+                              help='number of slabs processed at once')
+    batch_parser.add_argument('--report', help='JSON file with the state of every campaign')
+    batch_parser.set_defaults(func=batch, logs=True)
+
+    watch_parser = subparsers.add_parser(
+        'watch', help='follow the jobs of a campaign until they finish and run the next stages')
+    watch_parser.add_argument('-m', '--manifest', default='jobs.sqlite',
+                              help='job manifest of the campaign')
+    watch_parser.add_argument('-i', '--interval', type=float, default=30.,
+                              help='seconds between checks of the job directories')
+    watch_parser.add_argument('-n', '--max-concurrent', type=int, default=4,
+                              help='maximum number of outputs read or stages run at once')
+    watch_parser.add_argument('--timeout', type=float, help='seconds before giving up')
+    watch_parser.add_argument('--single-point', action='store_true',
+                              help='submit a single point on the relaxed structure of each job')
+    watch_parser.add_argument('-c', '--config', default='config.ini',
+                              help='settings of the single points')
+    watch_parser.add_argument('--slab-energy', type=float,
+                              help='write the adsorption energies to adsorption.csv')
+    watch_parser.add_argument('--reference-energy', type=float, default=0.,
+                              help='energy of the adsorbate reference, e.g. 1/2 E(O2)')
+    watch_parser.add_argument('--debug', action='store_true')
+    watch_parser.set_defaults(func=watch, logs=True)
+
+    results_parser = subparsers.add_parser(
+        'results', help='energy and state of finished jobs, read from the end of their OUTCAR')
+    results_parser.add_argument('directories', nargs='*',
+                                help='directories of the jobs, the jobs of the manifest '
+                                     'if not given, every subdirectory if it has no jobs')
+    results_parser.add_argument('-m', '--manifest', default='jobs.sqlite',
+                                help='job manifest of the campaign')
+    results_parser.set_defaults(func=results, logs=False)
+
+    # options are passed to the script of the subcommand
+    check_parser = subparsers.add_parser('check', help='check_distance.py',
+                                         add_help=False)
+    check_parser.add_argument('argv', nargs='...')
+    check_parser.set_defaults(func=check, logs=False)
+
+    converge_parser = subparsers.add_parser('converge', help='optimize_parameters.py',
+                                            add_help=False)
+    converge_parser.add_argument('argv', nargs='...')
+    converge_parser.set_defaults(func=converge, logs=False)
+
+    relax_parser = subparsers.add_parser('relax', help='relax a structure')
+    relax_parser.add_argument('structure')
+    relax_parser.add_argument('-f', '--format')
+    relax_parser.add_argument('-c', '--config', default='config.ini')
+    relax_parser.add_argument('--pre-relax', choices=['emt', 'lj', 'none'], default='emt',
+                              help='classical potential of the pre-relaxation, '
+                                   'emt falls back to lj for elements it has no parameters for')
+    relax_parser.add_argument('--no-low-precision', action='store_true',
+                              help='skip the low precision DFT relaxation')
+    relax_parser.add_argument('--debug', action='store_true')
+    relax_parser.set_defaults(func=relax, logs=True)
+
+    # options of check and converge are unknown to this parser
+    if isinstance(argv, str):
+        argv = argv.split() or None
+    args, extra = parser.parse_known_args(argv)
+    if hasattr(args, 'argv'):
+        args.argv = extra + args.argv
+    elif extra:
+        parser.error(f'unrecognized arguments: {" ".join(extra)}')
+    if args.logs:
+        setup_logging(args.debug)
+        logger.debug(f'args:{vars(args)}')
+    if getattr(args, 'metrics', None):
+        instrumentation.enable(args.metrics)
+    return args
+
+
+def main(argv=''):
+    args = get_args(argv)
+    state = args.func(args)
+    if state is not None:
+        print(state)
+
+
+if __name__ == '__main__':
+    main()
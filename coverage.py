@@ -0,0 +1,266 @@
+from itertools import product
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, Union
+
+import numpy as np
+from ase.atoms import Atoms
+from ase.geometry import get_layers
+from numpy.linalg import norm
+
+from auto import center_at_origin, get_sites
+from placement import Placement, SlabTemplate
+from site_cache import SiteCache
+from sites import SiteIndex
+from symmetry import get_symmetry_operations
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+
+def site_distances(cell, positions: np.ndarray) -> np.ndarray:
+    """
+    Distances between sites in the xy plane using the minimum image,
+    heights are ignored since sites may be given at a periodic image in z
+    :param cell: cell of the surface, the first two vectors must lie in the xy plane
+    :param positions: (m, 3) positions of the sites
+    :return: (m, m) array
+    """
+    A = np.asarray(cell)[:2, :2]
+    scaled = np.asarray(positions, dtype=float)[:, :2] @ np.linalg.inv(A)
+    d = scaled[:, None] - scaled[None]
+    d -= np.round(d)
+    # rounding is not enough for skewed cells, neighbor images are checked too
+    distances = np.full(d.shape[:2], np.inf)
+    for shift in product((-1, 0, 1), repeat=2):
+        distances = np.minimum(distances, norm((d + shift) @ A, axis=2))
+    return distances
+
+
+def complete_sites(slab: Atoms, sites: List[Tuple[str, np.ndarray]], operations,
+                   tol: float=0.05) -> List[Tuple[str, np.ndarray]]:
+    """
+    Adds the symmetry images of the sites that are missing from the list,
+    new sites continue the numbering of their coordination
+    :param slab: Atoms the sites belong to
+    :param sites: list of (ID, position), IDs as given by gen_midpoints
+    :param operations: symmetry operations of the slab
+    :param tol: sites closer than `tol` in the xy plane are the same site
+    :return: list of (ID, position)
+    """
+    A = slab.cell[:2, :2]
+    inv = np.linalg.inv(A)
+    index = SiteIndex(slab.cell, tol)
+    numbers = dict()
+    for ID, position in sites:
+        index.add(position, ID)
+        coordination, number = map(int, ID.split('_'))
+        numbers[coordination] = max(numbers.get(coordination, -1), number)
+
+    sites = list(sites)
+    for ID, position in list(sites):
+        coordination = int(ID.split('_')[0])
+        for rotation, translation in operations:
+            scaled = (rotation @ (position[:2] @ inv) + translation) % 1
+            image = np.append(scaled @ A, position[2])
+            if image in index:
+                continue
+            numbers[coordination] += 1
+            new_ID = f'{coordination}_{numbers[coordination]}'
+            index.add(image, new_ID)
+            sites.append((new_ID, image))
+    return sites
+
+
+def site_permutations(slab: Atoms, positions: np.ndarray, operations,
+                      tol: float=0.05) -> List[List[int]]:
+    """
+    Permutation of the sites produced by each symmetry operation of the slab,
+    operations that map a site outside of the list are dropped
+    :param slab: Atoms the sites belong to
+    :param positions: (m, 3) positions of the sites
+    :param operations: symmetry operations of the slab
+    :param tol: sites closer than `tol` in the xy plane are the same site
+    :return: list of permutations, `perm[i]` is the index of the image of site `i`
+    """
+    A = slab.cell[:2, :2]
+    index = SiteIndex(slab.cell, tol)
+    for i, position in enumerate(positions):
+        index.add(position, i)
+
+    scaled = np.asarray(positions)[:, :2] @ np.linalg.inv(A)
+    permutations = []
+    for rotation, translation in operations:
+        images = (scaled @ rotation.T + translation) @ A
+        perm = [index.find(image) for image in images]
+        if None in perm:
+            logger.debug('symmetry operation dropped, a site has no image')
+            continue
+        permutations.append(perm)
+    return permutations
+
+
+def gen_assignments(counts: List[int]) -> Iterator[Tuple[int, ...]]:
+    """
+    Distinct sequences with `counts[k]` times species `k`, in lexicographic order
+    :param counts: number of sites of each species
+    :return: tuples of species indices
+    """
+    total = sum(counts)
+    if not total:
+        yield ()
+        return
+    for k, n in enumerate(counts):
+        if n:
+            rest = list(counts)
+            rest[k] -= 1
+            for tail in gen_assignments(rest):
+                yield (k,) + tail
+
+
+def is_canonical(config: Tuple[Tuple[int, int], ...],
+                 permutations: List[List[int]]) -> Tuple[bool, int]:
+    """
+    Checks if a configuration is the smallest of its symmetry orbit
+    :param config: sorted tuple of (site, species)
+    :param permutations: site permutations of the symmetry operations
+    :return: Tuple[is canonical, size of the orbit]
+    """
+    orbit = {config}
+    for perm in permutations:
+        image = tuple(sorted((perm[site], species) for site, species in config))
+        if image < config:
+            return False, 0
+        orbit.add(image)
+    return True, len(orbit)
+
+
+def gen_site_sets(neighbors: List[Set[int]], size: int,
+                  orbit_min: List[int]) -> Iterator[Tuple[int, ...]]:
+    """
+    Backtracking over the sets of `size` sites that are all neighbors of each other.
+    A canonical configuration starting at site `i` only has sites whose
+    symmetry orbit has no site before `i`, the other sites are pruned
+    :param neighbors: set of the compatible sites of each site
+    :param size: number of sites
+    :param orbit_min: smallest site index of the orbit of each site
+    :return: sorted tuples of site indices
+    """
+    def extend(chosen, candidates):
+        if len(chosen) == size:
+            yield tuple(chosen)
+            return
+        if len(chosen) + len(candidates) < size:
+            return
+        for k, j in enumerate(candidates):
+            yield from extend(chosen + [j],
+                              [c for c in candidates[k+1:] if c in neighbors[j]])
+
+    for i, neighbors_i in enumerate(neighbors):
+        if orbit_min[i] != i:
+            continue
+        yield from extend([i], sorted(j for j in neighbors_i
+                                      if j > i and orbit_min[j] >= i))
+
+
+def combined_adsorbate(adsorbates: Dict[str, Atoms], composition: Dict[str, int]) -> Atoms:
+    """
+    All the adsorbate atoms of a configuration, each species centered at the origin
+    :param adsorbates: Dict[name, Atoms]
+    :param composition: Dict[name, number of adsorbates]
+    :return: Atoms, species in the order of `composition`
+    """
+    combined = Atoms()
+    for name, n in composition.items():
+        ads = center_at_origin(adsorbates[name])
+        for _ in range(n):
+            combined += ads
+    return combined
+
+
+def coverage_composition(slab: Atoms, adsorbate: Atoms, coverage: float) -> Dict[str, int]:
+    """
+    Number of adsorbates for a coverage in monolayers, relative to the atoms of the top layer
+    :param slab: Atoms
+    :param adsorbate: Atoms
+    :param coverage: e.g. 0.25 for 1/4 ML
+    :return: Dict[formula of the adsorbate, number of adsorbates]
+    """
+    tags, layer_pos = get_layers(slab, (0, 0, 1), 0.3)
+    n_surface = np.count_nonzero(tags == max(tags))
+    n = int(round(coverage * n_surface))
+    if not n or abs(n - coverage * n_surface) > 1e-6:
+        raise ValueError(f'coverage {coverage} ML is not possible with {n_surface} surface atoms')
+    return {adsorbate.get_chemical_formula(mode='reduce'): n}
+
+
+def gen_coverages(slab: Atoms, adsorbates: Dict[str, Atoms], composition: Dict[str, int],
+                  min_dist: float=2.5, symmetry: bool=True, coordinations: Iterable[int]=None,
+                  tol: float=0.05, sites: Iterable[Tuple[str, np.ndarray]]=None,
+                  cache: Union[SiteCache, str]=None, **kw) -> Iterator[Tuple[str, Placement]]:
+    """
+    Places several adsorbates on the sites of the slab.
+    Sets of sites are enumerated by backtracking on the graph of sites at
+    least `min_dist` apart, so sets with two close sites are never extended.
+    With `symmetry`, only the lexicographically smallest configuration of
+    each symmetry orbit is yielded, sets that cannot be the smallest are
+    pruned and no configuration is stored
+    :param slab: Atoms
+    :param adsorbates: Dict[name, Atoms]
+    :param composition: Dict[name, number of adsorbates], e.g. {'O': 2, 'OH': 1}
+    :param min_dist: minimum distance between adsorption sites
+    :param symmetry: yield one configuration per symmetry orbit of the slab
+    :param coordinations: only use sites with these coordinations, e.g. (3,) for hollow sites
+    :param tol: sites closer than `tol` in the xy plane are the same site
+    :param sites: iterable of (ID, position), gen_midpoints sites and their
+        missing symmetry images if None
+    :param cache: SiteCache or the file name of one the gen_midpoints sites are read from
+    :param kw: gen_midpoints options
+    :return: Tuple[ID, Placement], the placement offsets are per adsorbate atom
+    """
+    operations = get_symmetry_operations(slab)
+    if sites is None:
+        # gen_midpoints can miss periodic images of a site at the cell boundary
+        sites = complete_sites(slab, get_sites(slab, cache, tol=tol, **kw), operations, tol)
+    if coordinations is not None:
+        coordinations = set(coordinations)
+        sites = ((ID, pos) for ID, pos in sites if int(ID.split('_')[0]) in coordinations)
+    sites = list(sites)
+    if not sites:
+        logger.warning('no adsorption sites to place the adsorbates on')
+        return
+    IDs = [ID for ID, pos in sites]
+    positions = np.array([pos for ID, pos in sites]).reshape(-1, 3)
+
+    names = [name for name, n in composition.items() if n]
+    counts = [composition[name] for name in names]
+    n_adsorbates = sum(counts)
+    n_atoms = [len(adsorbates[name]) for name in names]
+
+    distances = site_distances(slab.cell, positions)
+    neighbors = [set(np.nonzero(row >= min_dist)[0].tolist()) for row in distances]
+    if symmetry:
+        permutations = site_permutations(slab, positions, operations, tol)
+        orbit_min = np.min([range(len(sites))] + permutations, axis=0).tolist()
+    else:
+        permutations = []
+        orbit_min = list(range(len(sites)))
+    template = SlabTemplate(slab, combined_adsorbate(adsorbates, dict(zip(names, counts))))
+
+    n_configs = 0
+    for site_set in gen_site_sets(neighbors, n_adsorbates, orbit_min):
+        for species in gen_assignments(counts):
+            config = tuple(zip(site_set, species))
+            canonical, multiplicity = is_canonical(config, permutations)
+            if not canonical:
+                continue
+
+            # sites of each species, in the order of the combined adsorbate
+            ordered = sorted(config, key=lambda c: (c[1], c[0]))
+            offsets = np.repeat(positions[[site for site, s in ordered]],
+                                [n_atoms[s] for site, s in ordered], axis=0)
+            ID = '+'.join(f'{names[s]}-{IDs[site]}' for site, s in ordered)
+            logger.debug(f'{ID}: multiplicity {multiplicity}')
+            n_configs += 1
+            yield (ID, template.place(offsets, ID, multiplicity=multiplicity))
+    logger.info(f'{n_configs} configurations of {n_adsorbates} adsorbates '
+                f'on {len(sites)} sites')
@@ -1,19 +1,26 @@
 #!/bin/env python
 
 import logging
+import time
 
-from os import path, mkdir, chdir
+from os import path, chdir
 
 from ase.atoms import Atoms
 from ase.io import read
+from io import StringIO
 
-from auto import gen_structs
-from vasp import Vasp
-from vasp.exceptions import VaspSubmitted, VaspQueued
+from auto import gen_placements
+from coverage import combined_adsorbate, coverage_composition, gen_coverages
+from instrumentation import count, span, timed
+from manifest import JobManifest, input_hash, job_status, structure_hash
+from outcar import finished_energy
+from placement import Placement
+from submit import Scheduler, VaspScheduler, submit_all
+from writers import PoscarArchive, PoscarWriter, write_archive, write_poscars
 
-from reader import get_args, read_config
+from reader import find_settings, gen_settings, get_args, read_config, swept_names
 
-# from typing import
+from typing import Iterable, Tuple
 
 # ch = logging.StreamHandler()
 # ch.setLevel(logging.ERROR)
@@ -30,66 +37,216 @@ write_args_vasp = dict(format='vasp',
                        sort=True)
 
 
-def run_all(slab: Atoms, adsorbate: Atoms, config: dict, **opts):
+def gen_jobs(slab: Atoms, adsorbate: Atoms, coverage: float=None, min_dist: float=2.5,
+             **opts):
+    """
+    Placements of all the jobs of a campaign
+    :param slab: Atoms
+    :param adsorbate: Atoms
+    :param coverage: place several adsorbates, in monolayers, one adsorbate per job if None
+    :param min_dist: minimum distance between the sites of the adsorbates
+    :param opts: gen_placements or gen_coverages options
+    :return: Tuple[ID, Placement]
+    """
+    if not coverage:
+        return gen_placements(slab, adsorbate, **opts)
+    if opts.get('orientations'):
+        raise ValueError('orientations are not sampled for coverages')
+    composition = coverage_composition(slab, adsorbate, coverage)
+    adsorbates = {name: adsorbate for name in composition}
+    return gen_coverages(slab, adsorbates, composition, min_dist, **opts)
+
+
+def sweep_jobs(jobs: Iterable[Tuple[str, Placement]], config: dict):
+    """
+    Every job with every combination of the swept settings, see `reader.gen_settings`.
+    Neither the jobs nor the combinations are stored
+    :param jobs: iterable of (ID, structure)
+    :param config: Dict from `read_config`
+    :return: Tuple[ID, structure, settings], the ID is `<job ID>/<settings ID>`
+        if something is swept
+    """
+    for ID, struct in jobs:
+        for settings_ID, settings in gen_settings(config):
+            yield (f'{ID}/{settings_ID}' if settings_ID else ID, struct, settings)
+
+
+def archive_jobs(structs: Iterable[Tuple[str, Atoms]], config: dict):
+    """
+    Settings of the jobs of an archive written by `write_all`, their IDs
+    already end with the settings ID of the sweep, see `sweep_jobs`
+    :param structs: Tuple[ID, Atoms], see `read_archive`
+    :param config: Dict from `read_config`
+    :return: Tuple[ID, Atoms, settings], jobs whose settings are not in the sweep are skipped
+    """
+    swept = bool(swept_names(config))
+    for ID, struct in structs:
+        settings = find_settings(path.basename(ID) if swept else '', config)
+        if settings is None:
+            logger.warning(f'{ID}: settings not in the sweep of the configuration, skipped')
+            count('jobs', status='skipped')
+            continue
+        yield (ID, struct, settings)
+
+
+def read_archive(archive: PoscarArchive):
+    """
+    Reads the structures of an archive written by `write_all`
+    :param archive: PoscarArchive
+    :return: Tuple[ID, Atoms]
+    """
+    for ID in archive:
+        yield (ID, read(StringIO(archive.read(ID)), format='vasp'))
+
+
+@timed('run_all')
+def run_all(slab: Atoms, adsorbate: Atoms, config: dict, archive: str=None,
+            scheduler: Scheduler=None, max_workers: int=4, rate: float=None,
+            retries: int=3, manifest: str='jobs.sqlite', commit_interval: float=5.,
+            **opts):
     """
         Write input files to run all combinations of slab + adsorbate
         :param slab: Atoms
         :param adsorbate: Atoms
-        :param config: Dict,
-        :param opts: gen_struct options
+        :param config: Dict, settings swept over are run for every structure
+        :param archive: read the structures from this archive instead of generating them
+        :param scheduler: Scheduler used to submit the jobs, VaspScheduler if None
+        :param max_workers: maximum number of concurrent submissions
+        :param rate: maximum number of submissions per second
+        :param retries: number of times a failed submission is retried
+        :param manifest: job manifest, finished jobs are read from it instead of probed
+        :param commit_interval: seconds between commits of the manifest while submitting
+        :param opts: gen_jobs options
         :return:
         """
     results = []
+    failed = []
+
+    if archive:
+        archive = PoscarArchive(archive)
+        jobs = archive_jobs(read_archive(archive), config)
+    else:
+        jobs = sweep_jobs(gen_jobs(slab, adsorbate, **opts), config)
 
-    for ID, struct in gen_structs(slab, adsorbate, **opts):
+    scheduler = scheduler or VaspScheduler()
+    manifest = JobManifest(manifest)
 
-        calc = Vasp(ID, atoms=struct, **config)
-        logger.info(f'calculator for {ID} created')
-        try:
-            logger.info(f'{ID}: getting potential energy')
-            toten = calc.potential_energy
+    def unfinished(jobs):
+        for ID, struct, settings in jobs:
+            with span('run_all.manifest'):
+                struct_hash = structure_hash(struct)
+                config_hash = input_hash(settings)
+                toten = manifest.finished_energy(ID, struct_hash, config_hash)
+                if toten is None and manifest.same_inputs(ID, struct_hash, config_hash):
+                    # submitted before, a finished job is read without the calculator
+                    toten = finished_energy(ID)
+                    if toten is not None:
+                        manifest.update(ID, 'finished', toten)
+                if toten is None:
+                    manifest.update(ID, 'pending', structure_hash=struct_hash,
+                                    input_hash=config_hash,
+                                    multiplicity=getattr(struct, 'multiplicity', None))
+            if toten is not None:
+                logger.debug(f'{ID}: finished, energy read from manifest')
+                count('jobs', status='cached')
+                results.append(toten)
+                continue
+            yield (ID, struct, settings)
+
+    try:
+        last_commit = time.monotonic()
+        for ID, toten, error in submit_all(scheduler, unfinished(jobs), config,
+                                           max_workers, rate, retries):
             results.append(toten)
+            if error is not None:
+                # submitted again by the next run
+                status = 'failed'
+                failed.append(ID)
+            else:
+                status = 'submitted' if toten is None else 'finished'
+            count('jobs', status=status)
+            with span('run_all.manifest'):
+                manifest.update(ID, status, toten)
+                # status checks of the running campaign see the progress
+                if time.monotonic() - last_commit > commit_interval:
+                    manifest.commit()
+                    last_commit = time.monotonic()
             # TODO: do something
-
-        except (VaspSubmitted, VaspQueued) as e:
-            logger.info(f"Couldn't get energy:\n{e}")
-            results.append(None)
-            print(e)
+    finally:
+        manifest.close()
+        if archive:
+            archive.close()
 
     all_jobs = len(results)
     jobs_finished = all_jobs - results.count(None)
     state = f'{jobs_finished}/{all_jobs} jobs finished'
+    if failed:
+        state += f', {len(failed)} failed to submit: {" ".join(failed)}'
     return state
 
 
-def write_all(slab: Atoms, adsorbate: Atoms, **opts):
+@timed('write_all')
+def write_all(slab: Atoms, adsorbate: Atoms, config: dict=None, n_workers: int=8,
+              archive: str=None, manifest: str='jobs.sqlite', **opts):
     """
-    Write POSCAR of all combinations of slab + adsorbate
+    Write POSCAR of all combinations of slab + adsorbate,
+    files whose content didn't change are not rewritten
     :param slab: Atoms
     :param adsorbate: Atoms
-    :param opts: gen_struct options
+    :param config: calculator settings the structures will be run with,
+        one POSCAR per combination of the swept settings
+    :param n_workers: number of threads writing files
+    :param archive: write all POSCARs into this zip archive instead of one directory per job
+    :param manifest: job manifest with the digests of the files written before
+    :param opts: gen_jobs options
     :return:
     """
+    # all the adsorbate atoms of a job
+    adsorbates = adsorbate
+    if opts.get('coverage'):
+        composition = coverage_composition(slab, adsorbate, opts['coverage'])
+        adsorbates = combined_adsorbate({name: adsorbate for name in composition}, composition)
+    writer = PoscarWriter(slab, adsorbates, **write_args_vasp)
+    # the digests only cover the POSCARs, the calculator settings of each job
+    # are compared by `run_all` through the input hashes of the manifest
+    jobs = sweep_jobs(gen_jobs(slab, adsorbate, **opts), config or dict())
+    items = ((ID, placement.adsorbate_positions) for ID, placement, settings in jobs)
+
     results = []
-    for ID, struct in gen_structs(slab, adsorbate, **opts):
-        # create directory if it doesn't exist
-        if not path.isdir(ID):
-            mkdir(ID)
-            logger.debug(f'directory {ID} created')
-
-        fname = path.join(ID, 'POSCAR.vasp')
-        try:
-            struct.write(fname, **write_args_vasp)
-            logger.info(f'{ID}/POSCAR written')
-            results.append(1)
-
-        except Exception as e:
-            logger.error(e)
-            results.append(None)
-
-    n_structs = len(results)
-    n_written_structs = n_structs - results.count(None)
+    skipped = []
+    with JobManifest(manifest) as jobs:
+        if archive:
+            with PoscarArchive(archive, 'w') as bundle:
+                written = list(write_archive(bundle, writer, items))
+        else:
+            items = ((path.join(ID, 'POSCAR.vasp'), positions) for ID, positions in items)
+            written = write_poscars(writer, items, n_workers, makedirs=True,
+                                    digests=jobs.file_digests())
+
+        for fname, digest, error in written:
+            ID = path.dirname(fname) or fname
+            if error is not None:
+                logger.error(error)
+                count('poscars', status='failed')
+                results.append(None)
+            elif digest is None:
+                logger.debug(f'{ID}/POSCAR unchanged')
+                count('poscars', status='unchanged')
+                skipped.append(ID)
+            else:
+                if not archive:
+                    jobs.record_file(fname, digest)
+                logger.info(f'{ID}/POSCAR written')
+                count('poscars', status='written')
+                results.append(1)
+
+    if skipped:
+        logger.info(f'{len(skipped)} unchanged structures skipped: {" ".join(skipped)}')
+    n_structs = len(results) + len(skipped)
+    n_written_structs = len(results) - results.count(None)
     state = f'{n_written_structs}/{n_structs} structures written'
+    if skipped:
+        state += f', {len(skipped)} unchanged'
     return state
 
 
@@ -103,27 +260,59 @@ def get_adsorbate(adsorbate: str) -> Atoms:
     return ads
 
 
-def main(argv=''):
-    args = get_args(argv)
+def campaign_options(args) -> dict:
+    """
+    gen_jobs options from the command line arguments, see `reader.add_job_arguments`
+    """
+    # TODO: add options for gen_midpoints
+    opts = dict(symmetry=args.symmetry)
+    if args.coverage:
+        opts.update(coverage=args.coverage, min_dist=args.min_dist)
+    if args.orientations:
+        opts.update(orientations=args.orientations, max_polar=args.max_polar)
+    if args.site_cache:
+        opts.update(cache=args.site_cache)
+    return opts
 
-    if not args.poscar_only:
+
+def load_campaign(args) -> Tuple[Atoms, Atoms, dict, dict]:
+    """
+    Reads the inputs of a campaign from the command line arguments
+    :param args: arguments Namespace, see `reader.add_campaign_arguments`
+    :return: Tuple[slab, adsorbate, config, gen_struct options]
+    """
+    if path.isfile(args.config):
         config = read_config(args.config)
     else:
         config = dict()
 
-    # TODO: add options for gen_midpoints
-    opts = dict()
+    opts = campaign_options(args)
 
     slab = read(args.slab, format=args.format)
     logger.info(f'{args.slab} Atoms object created')
 
     adsorbate = get_adsorbate(args.ads)
     logger.info(f'{args.ads} Atoms object created')
+    return slab, adsorbate, config, opts
+
+
+def main(argv=''):
+    args = get_args(argv)
+
+    if args.status:
+        print(job_status(args.manifest))
+        return
+
+    slab, adsorbate, config, opts = load_campaign(args)
 
     if args.poscar_only:
-        state = write_all(slab, adsorbate, **opts)
+        state = write_all(slab, adsorbate, config, archive=args.archive,
+                          manifest=args.manifest, **opts)
     else:
-        state = run_all(slab, adsorbate, config, **opts)
+        archive = args.archive if args.archive and path.isfile(args.archive) else None
+        state = run_all(slab, adsorbate, config, archive=archive,
+                        max_workers=args.jobs, rate=args.rate,
+                        manifest=args.manifest, **opts)
     print(state)
 
 
@@ -0,0 +1,178 @@
+import atexit
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from functools import wraps
+from os import environ, path
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+# opt-in counters and timing spans of the generation pipeline.
+# While disabled `count` and `span` return right away, hot loops that need
+# extra work to compute a count should check `enabled` first
+
+enabled = False
+counters = defaultdict(int)
+# name -> [calls, seconds]
+spans = defaultdict(lambda: [0, 0.])
+_lock = threading.Lock()
+_null_span = nullcontext()
+_dump_files = []
+
+
+def _key(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    labels = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f'{name}{{{labels}}}'
+
+
+def count(name: str, n: int=1, **labels):
+    """
+    Adds `n` to the counter `name`
+    :param name: counter name
+    :param n: increment
+    :param labels: e.g. size=3, each combination of labels is a separate counter
+    """
+    if not enabled:
+        return
+    with _lock:
+        counters[_key(name, labels)] += int(n)
+
+
+class _Span:
+    __slots__ = ('key', 'start')
+
+    def __init__(self, key: str):
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            record = spans[self.key]
+            record[0] += 1
+            record[1] += elapsed
+
+
+def span(name: str, **labels):
+    """
+    Context manager adding the time spent inside it to the span `name`.
+    Spans of generators should not include a `yield`, or the time of the
+    consumer is included
+    :param name: span name
+    :param labels: e.g. size=3
+    """
+    if not enabled:
+        return _null_span
+    return _Span(_key(name, labels))
+
+
+def timed(name: str):
+    """
+    Decorator adding the time spent in the function to the span `name`
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable(fname: str=None):
+    """
+    Enables the instrumentation
+    :param fname: file the metrics are written to at exit, Prometheus text
+        format if it ends with `.prom`, JSON otherwise
+    """
+    global enabled
+    enabled = True
+    if fname:
+        # the working directory may change before exit
+        fname = path.abspath(fname)
+    if fname and fname not in _dump_files:
+        if not _dump_files:
+            atexit.register(_dump_at_exit)
+        _dump_files.append(fname)
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        counters.clear()
+        spans.clear()
+
+
+def snapshot() -> dict:
+    """
+    :return: Dict[counters, spans] with the current values
+    """
+    with _lock:
+        return dict(counters=dict(counters),
+                    spans={key: dict(calls=calls, seconds=seconds)
+                           for key, (calls, seconds) in spans.items()})
+
+
+def to_prometheus(metrics: dict, prefix: str='curlywaddle') -> str:
+    """
+    Formats a `snapshot` in the Prometheus text exposition format
+    """
+    # samples of the same metric must be grouped under its TYPE line
+    families = defaultdict(list)
+
+    def add(key, suffix, value):
+        name, _, labels = key.partition('{')
+        name = f'{prefix}_{name.replace(".", "_")}{suffix}'
+        labels = '{' + labels if labels else ''
+        families[name].append(f'{name}{labels} {value}')
+
+    for key, value in metrics['counters'].items():
+        add(key, '_total', value)
+    for key, record in metrics['spans'].items():
+        add(key, '_calls_total', record['calls'])
+        add(key, '_seconds_total', f'{record["seconds"]:.9f}')
+
+    lines = []
+    for name, samples in sorted(families.items()):
+        lines.append(f'# TYPE {name} counter')
+        lines.extend(sorted(samples))
+    return '\n'.join(lines) + '\n'
+
+
+def dump(fname: str):
+    """
+    Writes the metrics to `fname`, Prometheus text format if it ends with
+    `.prom`, JSON otherwise
+    """
+    metrics = snapshot()
+    with open(fname, 'w') as f:
+        if fname.endswith('.prom'):
+            f.write(to_prometheus(metrics))
+        else:
+            json.dump(metrics, f, indent=1, sort_keys=True)
+
+
+def _dump_at_exit():
+    for fname in _dump_files:
+        try:
+            dump(fname)
+        except OSError as e:
+            logger.error(f"Couldn't write metrics to {fname}\n{e}")
+
+
+# e.g. for campaigns run from cron
+if environ.get('CURLYWADDLE_METRICS'):
+    enable(environ['CURLYWADDLE_METRICS'])
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, Tuple
+
+import logging
+
+if TYPE_CHECKING:
+    from ase.atoms import Atoms
+
+logger = logging.getLogger('curlywaddle')
+
+
+def structure_hash(atoms: 'Atoms', decimals: int=6) -> str:
+    """
+    Hash of the atomic numbers, cell, positions and constraints of the structure
+    :param atoms: Atoms
+    :param decimals: positions and cell are rounded to this many decimals
+    :return: hex digest
+    """
+    # imported here so that status checks don't load numpy
+    import numpy as np
+
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(atoms.numbers, dtype=np.int64).tobytes())
+    for array in (atoms.cell[:], atoms.positions):
+        # adding 0 turns negative zeros into zeros
+        h.update(np.ascontiguousarray(np.round(array, decimals) + 0., dtype=float).tobytes())
+    if atoms.constraints:
+        constraints = [c.todict() for c in atoms.constraints]
+        h.update(json.dumps(constraints, sort_keys=True, default=_to_list).encode())
+    return h.hexdigest()
+
+
+def _to_list(obj):
+    return obj.tolist() if hasattr(obj, 'tolist') else str(obj)
+
+
+def input_hash(config: dict) -> str:
+    """
+    Hash of the calculator settings
+    :param config: Dict
+    :return: hex digest
+    """
+    text = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class JobManifest:
+    """
+    Persistent record of the jobs of a campaign, keyed by job ID.
+    Changes are committed when the manifest is closed
+    """
+    def __init__(self, fname: str='jobs.sqlite'):
+        self.fname = fname
+        self.connection = sqlite3.connect(fname)
+        self.connection.row_factory = sqlite3.Row
+        # readers (e.g. status checks) don't block a running campaign
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                   id TEXT PRIMARY KEY,
+                                   structure_hash TEXT,
+                                   input_hash TEXT,
+                                   status TEXT,
+                                   energy REAL,
+                                   created REAL,
+                                   updated REAL,
+                                   multiplicity INTEGER)''')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(jobs)')]
+        if 'multiplicity' not in columns:
+            # manifests written before multiplicities were recorded
+            self.connection.execute('ALTER TABLE jobs ADD COLUMN multiplicity INTEGER')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS files (
+                                   path TEXT PRIMARY KEY,
+                                   digest TEXT,
+                                   updated REAL)''')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self):
+        """
+        Makes the changes visible to other readers, e.g. status checks of a running campaign
+        """
+        self.connection.commit()
+
+    def get(self, ID: str) -> dict:
+        row = self.connection.execute('SELECT * FROM jobs WHERE id = ?', (ID,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def update(self, ID: str, status: str, energy: float=None,
+               structure_hash: str=None, input_hash: str=None, multiplicity: int=None):
+        """
+        Creates or updates a job, hashes and multiplicity are kept if they are not given
+        :param ID: job ID
+        :param status: e.g. 'pending', 'submitted', 'finished'
+        :param energy: energy of a finished job
+        :param structure_hash: hash of the structure
+        :param input_hash: hash of the calculator settings
+        :param multiplicity: number of equivalent jobs the job stands for
+        """
+        now = time.time()
+        self.connection.execute(
+            '''INSERT INTO jobs (id, structure_hash, input_hash, status, energy,
+                                created, updated, multiplicity)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+               structure_hash = coalesce(excluded.structure_hash, structure_hash),
+               input_hash = coalesce(excluded.input_hash, input_hash),
+               status = excluded.status,
+               energy = excluded.energy,
+               updated = excluded.updated,
+               multiplicity = coalesce(excluded.multiplicity, multiplicity)''',
+            (ID, structure_hash, input_hash, status, energy, now, now, multiplicity))
+
+    def jobs(self, statuses: Iterable[str]=None) -> List[dict]:
+        """
+        :param statuses: only the jobs with one of these statuses, all the jobs if None
+        :return: list of jobs
+        """
+        if statuses is None:
+            rows = self.connection.execute('SELECT * FROM jobs ORDER BY id')
+        else:
+            statuses = list(statuses)
+            marks = ', '.join('?' * len(statuses))
+            rows = self.connection.execute(
+                f'SELECT * FROM jobs WHERE status IN ({marks}) ORDER BY id', statuses)
+        return [dict(row) for row in rows]
+
+    def finished_energy(self, ID: str, structure_hash: str, input_hash: str) -> float:
+        """
+        Returns the energy of the job if it finished with the same inputs, None otherwise
+        """
+        job = self.get(ID)
+        if job is None or job['status'] != 'finished' \
+                or job['structure_hash'] != structure_hash or job['input_hash'] != input_hash:
+            return None
+        return job['energy']
+
+    def same_inputs(self, ID: str, structure_hash: str, input_hash: str) -> bool:
+        """
+        Whether the job was recorded before with the same structure and settings
+        """
+        job = self.get(ID)
+        return job is not None and job['structure_hash'] == structure_hash \
+            and job['input_hash'] == input_hash
+
+    def file_digests(self) -> Dict[str, str]:
+        """
+        :return: Dict[path, digest] of the input files written so far
+        """
+        return dict(self.connection.execute('SELECT path, digest FROM files'))
+
+    def record_file(self, path: str, digest: str):
+        self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                                (path, digest, time.time()))
+
+    def summary(self) -> Tuple[int, int]:
+        """
+        :return: Tuple[finished jobs, all jobs]
+        """
+        finished, total = self.connection.execute(
+            "SELECT count(CASE WHEN status = 'finished' THEN 1 END), count(*) FROM jobs").fetchone()
+        return finished, total
+
+
+def job_status(fname: str='jobs.sqlite') -> str:
+    """
+    Number of finished jobs of a campaign, the manifest is not created if it doesn't exist
+    """
+    if not os.path.isfile(fname):
+        return f'job manifest `{fname}` not found'
+    with JobManifest(fname) as manifest:
+        jobs_finished, all_jobs = manifest.summary()
+    return f'{jobs_finished}/{all_jobs} jobs finished'
+
+
+def batch_status(directory: str, manifest: str='jobs.sqlite') -> str:
+    """
+    Aggregated status of the campaigns in the subdirectories of `directory`,
+    e.g. written by `batch.run_batch`
+    """
+    lines = []
+    finished = total = 0
+    for name in sorted(os.listdir(directory)):
+        fname = os.path.join(directory, name, manifest)
+        if not os.path.isfile(fname):
+            continue
+        with JobManifest(fname) as jobs:
+            jobs_finished, all_jobs = jobs.summary()
+        lines.append(f'{name:30} {jobs_finished}/{all_jobs} jobs finished')
+        finished += jobs_finished
+        total += all_jobs
+    lines.append(f'{len(lines)} campaigns, {finished}/{total} jobs finished')
+    return '\n'.join(lines)
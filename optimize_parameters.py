@@ -1,20 +1,27 @@
 #!/usr/bin/env python
 
 import argparse
-import matplotlib.pyplot as plt
-from matplotlib.axes import Axes
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from itertools import count
-from ase.io import read
+from math import ceil, log
 from ase.atoms import Atoms
-from vasp import Vasp
-from typing import Iterable
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Sequence, Tuple
 from numbers import Real
 import logging
+import time
+
+if TYPE_CHECKING:
+    from matplotlib.axes import Axes
+
+logger = logging.getLogger('curlywaddle')
 
 # single point calculations of small systems should be fast
 
 
-def run_vasp(atoms: Atoms):
+def run_vasp(atoms: Atoms, joint: bool=False):
     xc = 'PBE'
     init_kpoints = (5, 5, 5)
     incar = dict(
@@ -23,55 +30,316 @@ def run_vasp(atoms: Atoms):
         sigma=0.05,
         nelm=200,
         nsw=200)
-    calc = Vasp('',
-                xc=xc,
-                kpoints=init_kpoints,
-                **incar)
-    atoms.set_calculator(calc)
+    calc_params = dict(xc=xc,
+                       kpoints=init_kpoints,
+                       **incar)
 
-    calc_params = dict()
+    if joint:
+        optimize_grid(atoms, encuts=range(250, 601, 50), kpoints=range(3, 10),
+                      calc_params=calc_params, threshold=1e-2)
+        return
 
     plot_params = dict(save_plot=True)
     encut_params = dict(start=250, step=50)
-    optimize(atoms, 'encut', params=encut_params,
+    optimize(atoms, 'encut', params=encut_params, calc_params=calc_params,
              threshold=1e-2, plot_params=plot_params)
 
     # kpoint_params = dict(start=3, step=1)
-    # optimize(atoms, 'kpoints', params=kpoint_params,
+    # optimize(atoms, 'kpoints', params=kpoint_params, calc_params=calc_params,
     #          threshold=1e-2, plot_params=plot_params)
     return
 
 
 def gen_calculation(atoms: Atoms, parameter: str, start: int, step: int=1, calc_params: dict={}):
     for val in count(start, step):
-        name = f''
-        Vasp(name, **calc_params)
-        atoms.calc.set(**{parameter: val})
-        yield (val, atoms.get_total_energy())
+        yield (val, calc_energy(atoms, parameter, val, calc_params))
+
+
+def calc_energy(atoms: Atoms, parameter: str, value, calc_params: dict={}) -> float:
+    """
+    Single point energy of `atoms` with `parameter` set to `value`,
+    each value runs in its own directory
+    """
+    return calc_settings_energy(atoms, {parameter: value}, calc_params)
+
+
+def calc_settings_energy(atoms: Atoms, settings: dict, calc_params: dict={}) -> float:
+    """
+    Single point energy of `atoms` with `settings` on top of `calc_params`,
+    each combination of settings runs in its own directory
+    """
+    # imported here so that `converge` and `--help` don't need the calculator
+    from vasp import Vasp
+
+    params = dict(calc_params)
+    label = []
+    for parameter, value in settings.items():
+        if parameter == 'kpoints' and isinstance(value, int):
+            value = (value, value, value)
+        params[parameter] = value
+        label.append(f'{parameter}_' + '_'.join(map(str, np.atleast_1d(value))))
+    atoms = atoms.copy()
+    Vasp('_'.join(label), atoms=atoms, **params)
+    return atoms.get_total_energy()
+
+
+def calc_grid_energy(atoms: Atoms, encut: Real, kpoints, calc_params: dict={}) -> float:
+    return calc_settings_energy(atoms, dict(encut=encut, kpoints=kpoints), calc_params)
+
+
+def fit_asymptote(x: Iterable[Real], y: Iterable[Real]) -> Tuple[float, float, float]:
+    """
+    Least squares fit of `y = c + a*exp(-b*(x - min(x)))`.
+    `b` is searched on a logarithmic grid and refined by golden section,
+    `c` and `a` are linear for a given `b`
+    :param x: parameter values
+    :param y: energies
+    :return: Tuple[c, a, b]
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    scale = np.ptp(x) or 1.
+    t = (x - x.min()) / scale
+
+    def solve(log_b):
+        M = np.stack([np.ones_like(t), np.exp(-np.exp(log_b) * t)], axis=1)
+        coef = np.linalg.lstsq(M, y, rcond=None)[0]
+        return np.linalg.norm(M @ coef - y), coef
+
+    log_bs = np.linspace(log(1e-2), log(1e2), 81)
+    k = int(np.argmin([solve(log_b)[0] for log_b in log_bs]))
+    lo, hi = log_bs[max(k - 1, 0)], log_bs[min(k + 1, len(log_bs) - 1)]
+    ratio = (5 ** .5 - 1) / 2
+    for _ in range(40):
+        m1, m2 = hi - ratio * (hi - lo), lo + ratio * (hi - lo)
+        if solve(m1)[0] < solve(m2)[0]:
+            hi = m2
+        else:
+            lo = m1
+    log_b = (lo + hi) / 2
+    c, a = solve(log_b)[1]
+    return c, a, np.exp(log_b) / scale
+
+
+def converge(energy: Callable[[Real], float], start: Real, step: Real=1,
+             threshold: float=1e-2, max_iterations: int=15, max_workers: int=2,
+             max_jump: int=4, executor=ThreadPoolExecutor) -> Tuple[Real, Dict[Real, float]]:
+    """
+    Finds the smallest value in `start + i*step` whose energy differs less
+    than `threshold` from the energy of the next value.
+    The energies are fitted to `c + a*exp(-b*x)` and the next pair of
+    values is placed where the fit is converged, the values of each
+    iteration are calculated concurrently. Once a pair converges, smaller
+    values the fit predicts to be converged are checked too
+    :param energy: function returning the energy for a value of the parameter
+    :param start: first value
+    :param step: step between values
+    :param threshold: energy convergence threshold
+    :param max_iterations: maximum number of energy calculations, at least 1
+    :param max_workers: maximum number of concurrent calculations
+    :param max_jump: maximum number of steps beyond the largest value calculated
+    :param executor: concurrent.futures.Executor class running `energy`
+    :return: Tuple[converged value, Dict[value, energy]]
+    """
+    if max_iterations < 1:
+        raise ValueError(f'max_iterations must be at least 1, got {max_iterations}')
+    # energies keyed by the index i of the value start + i*step, so that
+    # non-integer steps don't miss lookups because of rounding
+    energies = dict()
+
+    def value(i):
+        return start + i * step
+
+    def grid(x):
+        return max(0, ceil((x - start) / step - 1e-9))
+
+    def converged():
+        for i in sorted(energies):
+            if i + 1 in energies and abs(energies[i] - energies[i + 1]) < threshold:
+                return i
+        return None
+
+    def predicted():
+        """ smallest index converged according to the fit, None if the fit is not decaying """
+        c, a, b = fit_asymptote([value(i) for i in energies], list(energies.values()))
+        if not a or b <= 0:
+            return None
+        # energy difference to the next value: |a|*exp(-b*x)*(1 - exp(-b*step))
+        difference = abs(a) * (1 - np.exp(-b * step))
+        return grid(value(min(energies)) + log(max(difference / threshold, 1.)) / b)
+
+    def next_indices():
+        i_max = max(energies)
+        i = predicted()
+        indices = []
+        if i is not None:
+            i = min(i, i_max + max_jump)
+            indices = [j for j in (i, i + 1) if j not in energies]
+        # the fit is already converged at calculated values, go on linearly
+        return indices or [i_max + 1, i_max + 2]
 
+    def refine_indices(index):
+        # the fit may predict that a smaller value is also converged
+        i = predicted()
+        if i is None or i >= index:
+            return []
+        return [j for j in (i, i + 1) if j not in energies]
 
-def optimize(atoms: Atoms, parameter: str, params: dict={},
-             threshold: float=1e-2, max_iterations: int=15,
+    with executor(max_workers) as pool:
+        indices = [0, 1, 2]
+        while indices:
+            indices = indices[:max_iterations - len(energies)]
+            energies.update(zip(indices, pool.map(energy, [value(i) for i in indices])))
+            index = converged()
+            if len(energies) >= max_iterations:
+                indices = []
+            elif index is None:
+                indices = next_indices()
+            else:
+                indices = refine_indices(index)
+
+    values = {value(i): energies[i] for i in sorted(energies)}
+    if index is not None:
+        return value(index), values
+    logger.warning(f'not converged after {len(energies)} calculations')
+    return value(max(energies)), values
+
+
+def optimize(atoms: Atoms, parameter: str, params: dict={}, calc_params: dict={},
+             threshold: float=1e-2, max_iterations: int=15, max_workers: int=2,
              plot_params: dict={}):
-    values = []
-    energies = []
-    # TODO: add optimization algorithm
-    # naive approach
-    prev_energy = float('inf')
-    for i, (value, energy) in enumerate(gen_calculation(atoms, calc_params, change_params)):
-        values.append(value)
-        energies.append(energy)
-        if abs(energy - prev_energy) < threshold or i >= max_iterations:
-            break
-        prev_energy = energy
+    """
+    Converges `parameter` of the calculator
+    :param atoms: Atoms
+    :param parameter: e.g. 'encut' or 'kpoints'
+    :param params: `start` and `step` of the parameter values
+    :param calc_params: other calculator settings
+    :param threshold: energy convergence threshold
+    :param max_iterations: maximum number of energy calculations
+    :param max_workers: maximum number of concurrent calculations
+    :param plot_params: `plot` options, no plot if empty
+    :return: converged value
+    """
+    energy = partial(calc_energy, atoms, parameter, calc_params=calc_params)
+    value, energies = converge(energy, threshold=threshold, max_iterations=max_iterations,
+                               max_workers=max_workers, executor=ProcessPoolExecutor,
+                               **params)
+    logger.info(f'{parameter} converged at {value} after {len(energies)} calculations')
 
     # plotting section
     if plot_params:
-        plot(parameter, values, energies, **plot_params)
+        values = sorted(energies)
+        plot(parameter, values, [energies[v] for v in values], **plot_params)
+    return value
+
+
+def grid_cost(encut: Real, kpoints) -> float:
+    """
+    Relative cost of a calculation, ~ encut**1.5 (plane waves) times the number of k-points
+    """
+    if isinstance(kpoints, int):
+        kpoints = (kpoints, kpoints, kpoints)
+    return encut ** 1.5 * np.prod(kpoints)
+
+
+def _timed(function: Callable, *args) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    return function(*args), time.perf_counter() - start
+
+
+def converge_grid(energy: Callable[[Real, Any], float], encuts: Sequence[Real],
+                  kpoints: Sequence, threshold: float=1e-2, max_workers: int=4,
+                  executor=ThreadPoolExecutor,
+                  cost: Callable[[Real, Any], float]=grid_cost) -> Tuple[Tuple, Dict[Tuple, Tuple[float, float]]]:
+    """
+    Finds the cheapest (encut, kpoints) whose energy differs less than
+    `threshold` from the energies with the next encut and the next kpoints.
+    Candidates are tried in order of `cost` and their points calculated
+    concurrently, once a candidate is converged the more expensive region
+    of the grid is not calculated
+    :param energy: function returning the energy for (encut, kpoints)
+    :param encuts: increasing encut values
+    :param kpoints: increasing kpoints values
+    :param threshold: energy convergence threshold
+    :param max_workers: maximum number of concurrent calculations
+    :param executor: concurrent.futures.Executor class running `energy`
+    :param cost: function returning the relative cost of (encut, kpoints)
+    :return: Tuple[(encut, kpoints) or None, Dict[(encut, kpoints), (energy, seconds)]]
+    """
+    results = dict()
+
+    def neighbors(candidate):
+        i, j = candidate
+        return [candidate, (i + 1, j), (i, j + 1)]
+
+    def converged(candidate):
+        e0, *es = (results[p][0] for p in neighbors(candidate))
+        return all(abs(e - e0) < threshold for e in es)
+
+    def setting(point):
+        return encuts[point[0]], kpoints[point[1]]
+
+    candidates = deque(sorted(((i, j) for i in range(len(encuts) - 1)
+                               for j in range(len(kpoints) - 1)),
+                              key=lambda c: cost(*setting(c))))
+    best = None
+
+    with executor(max_workers) as pool:
+        while candidates and best is None:
+            # cheapest candidates until there are enough points for every worker
+            batch = []
+            points = []
+            while candidates and len(points) < max_workers:
+                batch.append(candidates.popleft())
+                new_points = [p for p in neighbors(batch[-1])
+                              if p not in results and p not in points]
+                if not points and not new_points and converged(batch[-1]):
+                    # the cheaper candidates of the batch are calculated and not converged
+                    best = batch[-1]
+                    break
+                points += new_points
+            if best is not None:
+                break
+            futures = {p: pool.submit(_timed, energy, *setting(p)) for p in points}
+            for p, future in futures.items():
+                results[p] = future.result()
+                logger.debug(f'encut {setting(p)[0]}, kpoints {setting(p)[1]}: '
+                             f'{results[p][0]} in {results[p][1]:.1f} s')
+            best = next((c for c in batch if converged(c)), None)
+
+    if best is None:
+        logger.warning(f'encut and kpoints not converged after {len(results)} calculations')
+    else:
+        best = setting(best)
+    return best, {setting(p): result for p, result in results.items()}
+
+
+def optimize_grid(atoms: Atoms, encuts: Sequence[Real], kpoints: Sequence,
+                  calc_params: dict={}, threshold: float=1e-2, max_workers: int=4):
+    """
+    Converges encut and kpoints together
+    :param atoms: Atoms
+    :param encuts: increasing encut values
+    :param kpoints: increasing kpoints values
+    :param calc_params: other calculator settings
+    :param threshold: energy convergence threshold
+    :param max_workers: maximum number of concurrent calculations
+    :return: cheapest converged (encut, kpoints)
+    """
+    energy = partial(calc_grid_energy, atoms, calc_params=calc_params)
+    best, results = converge_grid(energy, list(encuts), list(kpoints), threshold,
+                                  max_workers, executor=ProcessPoolExecutor)
+    print(f'{"encut":>8} {"kpoints":>10} {"energy":>14} {"seconds":>10}')
+    for (encut, kpts), (toten, seconds) in sorted(results.items(), key=lambda r: r[1][1]):
+        print(f'{encut:>8} {str(kpts):>10} {toten:14.6f} {seconds:10.1f}')
+    print(f'converged: encut {best[0]}, kpoints {best[1]}' if best else 'not converged')
+    return best
 
 
 def plot(name: str, x: Iterable[Real], y: Iterable[Real],
-         ax: Axes=None, save_plot: bool=False, **kwargs):
+         ax: 'Axes'=None, save_plot: bool=False, **kwargs):
+    import matplotlib.pyplot as plt
+
     if ax is None:
         fig = plt.figure(name)
         ax = fig.add_subplot(111)
@@ -98,21 +366,26 @@ def get_args(argv: str=''):
                         help='filename to read atoms from')
     parser.add_argument('-f', '--format',
                         help='format of atoms file')
+    parser.add_argument('--joint', action='store_true',
+                        help='converge encut and kpoints together')
 
-    # read arguments
+    # read arguments, from terminal if `argv` is an empty string
     if isinstance(argv, str):
-        argv = argv.split()
+        argv = argv.split() or None
     elif not hasattr(argv, '__iter__'):
         raise TypeError(f'argv must be `str` or iterable, not {type(argv)}')
-    args = parser.parse_args(argv) if argv else parser.parse_args()
+    args = parser.parse_args(argv)
 
     return args
 
 
 def main(argv=''):
     args = get_args(argv)
+
+    from ase.io import read
+
     atoms = read(args.atoms, format=args.format)
-    run_vasp(atoms)
+    run_vasp(atoms, joint=args.joint)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+from itertools import product
+from typing import Iterator, Tuple
+
+import numpy as np
+from ase.atoms import Atoms
+from ase.data import covalent_radii
+from numpy.linalg import norm
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+
+def rotation_z(angle: float) -> np.ndarray:
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+
+def rotation_y(angle: float) -> np.ndarray:
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+
+def rotation_grid(n_polar: int=3, n_azimuthal: int=6, max_polar: float=90.,
+                  n_spin: int=1) -> np.ndarray:
+    """
+    Rotations that tilt the z axis of the adsorbate by `n_polar` angles in
+    [0, max_polar] towards `n_azimuthal` directions and spin it `n_spin` times
+    around its own axis. The upright orientation is the first one, the
+    azimuthal directions of the upright and upside down orientations are not repeated
+    :param n_polar: number of polar angles
+    :param n_azimuthal: number of azimuthal angles
+    :param max_polar: largest polar angle in degrees
+    :param n_spin: rotations around the axis of the adsorbate, 1 for linear adsorbates
+    :return: (r, 3, 3) array of rotation matrices
+    """
+    polar = np.radians(np.linspace(0, max_polar, n_polar))
+    azimuthal = np.linspace(0, 2 * np.pi, n_azimuthal, endpoint=False)
+    spin = np.linspace(0, 2 * np.pi, n_spin, endpoint=False)
+
+    rotations = []
+    for theta in polar:
+        # all azimuthal angles give the same axis when it is along z
+        on_axis = np.isclose(np.sin(theta), 0.)
+        for phi in ([0.] if on_axis else azimuthal):
+            for psi in spin:
+                rotations.append(rotation_z(phi) @ rotation_y(theta) @ rotation_z(psi))
+    return np.array(rotations)
+
+
+def is_linear(atoms: Atoms, tol: float=1e-3) -> bool:
+    """
+    Whether all the atoms lie on the z axis, e.g. an upright OH
+    """
+    return bool(np.all(norm(atoms.positions[:, :2], axis=1) < tol))
+
+
+class ClashChecker:
+    """
+    Rejects poses of an adsorbate that overlap the slab.
+    Periodic images of the slab are built once, each site only compares the
+    poses against the slab atoms within reach of the site
+    """
+    def __init__(self, slab: Atoms, scale: float=0.8):
+        """
+        :param slab: Atoms
+        :param scale: atoms closer than `scale` times the sum of their
+            covalent radii clash
+        """
+        self.scale = scale
+        # sites may be at any periodic image, also in z
+        shifts = np.array(list(product((-1, 0, 1), repeat=3))) @ slab.cell[:]
+        self.positions = (slab.positions[None] + shifts[:, None]).reshape(-1, 3)
+        self.radii = np.tile(covalent_radii[slab.numbers], len(shifts))
+        self.max_radius = self.radii.max() if len(self.radii) else 0.
+
+    def clashes(self, poses: np.ndarray, numbers: np.ndarray) -> np.ndarray:
+        """
+        Checks all the poses of an adsorbate at once
+        :param poses: (r, k, 3) positions of the `k` adsorbate atoms in each pose
+        :param numbers: (k,) atomic numbers of the adsorbate
+        :return: (r,) bool array, True if the pose clashes with the slab
+        """
+        radii = covalent_radii[numbers]
+        center = poses.reshape(-1, 3).mean(axis=0)
+        reach = norm(poses - center, axis=2).max() + self.scale * (radii.max() + self.max_radius)
+        near = norm(self.positions - center, axis=1) < reach
+        if not near.any():
+            return np.zeros(len(poses), dtype=bool)
+
+        d = norm(poses[:, :, None] - self.positions[near][None, None], axis=3)
+        limit = self.scale * (radii[:, None] + self.radii[near][None])
+        return np.any(d < limit, axis=(1, 2))
+
+
+def gen_poses(checker: ClashChecker, adsorbate: Atoms, point: np.ndarray,
+              rotations: np.ndarray) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Viable orientations of the adsorbate at `point`
+    :param checker: ClashChecker of the slab
+    :param adsorbate: Atoms centered at the origin
+    :param point: position of the site
+    :param rotations: (r, 3, 3) rotation matrices
+    :return: Tuple[index of the rotation, rotation]
+    """
+    poses = np.einsum('rij,kj->rki', rotations, adsorbate.positions) + point
+    clashes = checker.clashes(poses, adsorbate.numbers)
+    for k in np.nonzero(~clashes)[0]:
+        yield (int(k), rotations[k])
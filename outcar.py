@@ -0,0 +1,145 @@
+import mmap
+import re
+from os import path
+from typing import Optional
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+# printed at the end of the OUTCAR of every job that ran to completion
+FINISHED = b'General timing and accounting informations for this job'
+# only the timing of the job is printed after it
+FINISHED_WINDOW = 2**16
+# printed when a relaxation converged
+CONVERGED = b'reached required accuracy'
+ITERATION = re.compile(rb'-+\s*Iteration\s+(\d+)\(\s*\d+\)')
+ENERGY = re.compile(rb'energy\(sigma->0\)\s*=\s*(\S+)')
+FREE_ENERGY = re.compile(rb'free\s+energy\s+TOTEN\s*=\s*(\S+)')
+NSW = re.compile(rb'NSW\s*=\s*(\d+)')
+ELAPSED = re.compile(rb'Elapsed time \(sec\):\s*(\S+)')
+OSZICAR_STEP = re.compile(rb'^\s*(\d+)\s+F=\s*(\S+)\s+E0=\s*(\S+)', re.MULTILINE)
+
+
+def last_line(mm: mmap.mmap, marker: bytes, end: int=None) -> Optional[bytes]:
+    """
+    Last line containing `marker` before `end`, the file is searched backwards from the end
+    :param mm: mapped file
+    :param marker: text of the line
+    :param end: position the search starts from, the end of the file if None
+    :return: line without the newline, None if no line has the marker
+    """
+    i = mm.rfind(marker, 0, len(mm) if end is None else end)
+    if i < 0:
+        return None
+    start = mm.rfind(b'\n', 0, i) + 1
+    stop = mm.find(b'\n', i)
+    return mm[start:stop if stop >= 0 else len(mm)]
+
+
+def read_outcar(fname: str='OUTCAR') -> dict:
+    """
+    Final energy and state of a job, read from the end of its OUTCAR
+    without parsing the rest of the file
+    :param fname: OUTCAR file
+    :return: Dict with the `energy` (sigma->0), `free_energy`, number of
+        `ionic_steps`, whether the job `finished` and whether it `converged`,
+        wall time of a finished job in seconds (`elapsed`), None for the values
+        that were not found. Empty if the file doesn't exist
+    """
+    if not path.isfile(fname) or not path.getsize(fname):
+        return dict()
+    with open(fname, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        finished = mm.rfind(FINISHED, max(0, len(mm) - FINISHED_WINDOW)) >= 0
+        # the last energy block is after the last iteration header
+        last_iteration = max(mm.rfind(b'Iteration'), 0)
+        line = last_line(mm, b'Iteration')
+        match = ITERATION.search(line) if line else None
+        ionic_steps = int(match.group(1)) if match else 0
+        energy = free_energy = None
+        line = last_line(mm, b'energy(sigma->0)')
+        if line is not None:
+            energy = float(ENERGY.search(line).group(1))
+        line = last_line(mm, b'TOTEN')
+        if line is not None and FREE_ENERGY.search(line):
+            free_energy = float(FREE_ENERGY.search(line).group(1))
+
+        # printed after the last electronic step, only the end of the file is searched
+        converged = finished and mm.rfind(CONVERGED, last_iteration) >= 0
+        if finished and not converged:
+            # single points don't print the convergence of the relaxation,
+            # NSW is in the header, near the start of the file
+            match = NSW.search(mm, 0, mm.find(b'Iteration'))
+            converged = match is not None and int(match.group(1)) <= 1
+        elapsed = None
+        if finished:
+            line = last_line(mm, b'Elapsed time')
+            elapsed = float(ELAPSED.search(line).group(1)) if line else None
+
+    return dict(energy=energy, free_energy=free_energy, ionic_steps=ionic_steps,
+                finished=finished, converged=converged, elapsed=elapsed)
+
+
+def read_oszicar(fname: str='OSZICAR') -> dict:
+    """
+    Energies of the last ionic step of a job, OSZICAR is much smaller than OUTCAR
+    but doesn't tell if the job finished
+    :param fname: OSZICAR file
+    :return: Dict with the `energy` (E0), `free_energy` (F) and number of
+        `ionic_steps`, empty if the file doesn't exist or has no ionic step
+    """
+    if not path.isfile(fname) or not path.getsize(fname):
+        return dict()
+    with open(fname, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        line = last_line(mm, b'F=')
+    match = OSZICAR_STEP.search(line) if line else None
+    if match is None:
+        return dict()
+    return dict(energy=float(match.group(3)), free_energy=float(match.group(2)),
+                ionic_steps=int(match.group(1)))
+
+
+def read_results(directory: str='.') -> dict:
+    """
+    Energy and state of the job in `directory`, see `read_outcar`.
+    Outputs older than the INCAR are from a previous run and are ignored
+    :param directory: directory of the job
+    :return: Dict, empty if the job has no outputs
+    """
+    outcar = path.join(directory, 'OUTCAR')
+    incar = path.join(directory, 'INCAR')
+    if not path.isfile(outcar):
+        return dict()
+    if path.isfile(incar) and path.getmtime(outcar) < path.getmtime(incar):
+        logger.debug(f'{directory}: OUTCAR is older than INCAR')
+        return dict()
+    results = read_outcar(outcar)
+    if results.get('energy') is None:
+        # the OUTCAR is buffered, OSZICAR may have the last step already
+        results.update(read_oszicar(path.join(directory, 'OSZICAR')))
+    return results
+
+
+def finished_energy(directory: str='.') -> Optional[float]:
+    """
+    Energy of a job that finished and converged, read without the calculator
+    :param directory: directory of the job
+    :return: energy, None if the job didn't finish
+    """
+    results = read_results(directory)
+    if results.get('finished') and results.get('converged'):
+        return results['energy']
+    return None
+
+
+def format_results(directory: str, results: dict) -> str:
+    """
+    One line with the energy, number of ionic steps and state of a job
+    """
+    if not results:
+        return f'{directory+":":11} no outputs'
+    energy = results.get('energy')
+    energy = f'{energy:14.6f}' if energy is not None else f'{"-":>14}'
+    state = 'converged' if results.get('converged') else \
+        'finished' if results.get('finished') else 'running'
+    return f'{directory+":":11} {energy} {results.get("ionic_steps", 0):5d} {state}'
@@ -0,0 +1,111 @@
+from typing import Union
+
+import numpy as np
+from ase.atoms import Atoms
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+
+class SlabTemplate:
+    """
+    Read-only slab and adsorbate shared by all the placements of a campaign.
+    The arrays of the template are never copied by a placement
+    """
+    def __init__(self, slab: Atoms, adsorbate: Atoms):
+        """
+        :param slab: Atoms, copied once
+        :param adsorbate: Atoms centered at the origin, copied once
+        """
+        self.slab = slab.copy()
+        self.adsorbate = adsorbate.copy()
+        for atoms in (self.slab, self.adsorbate):
+            for array in atoms.arrays.values():
+                array.flags.writeable = False
+        self.n_slab = len(slab)
+        self.numbers = np.concatenate([slab.numbers, adsorbate.numbers])
+        self.numbers.flags.writeable = False
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def place(self, offset: np.ndarray, ID: str=None, rotation: np.ndarray=None,
+              multiplicity: int=1) -> 'Placement':
+        return Placement(self, offset, ID, rotation, multiplicity)
+
+
+class Placement:
+    """
+    Adsorbate of a SlabTemplate rotated about the origin by `rotation`
+    and translated by `offset`.
+    Exposes `numbers`, `cell`, `positions` and `constraints` like Atoms,
+    an Atoms object is only created by `to_atoms`
+    """
+    __slots__ = ('template', 'offset', 'ID', 'rotation', 'multiplicity')
+
+    def __init__(self, template: SlabTemplate, offset: np.ndarray, ID: str=None,
+                 rotation: np.ndarray=None, multiplicity: int=1):
+        """
+        :param template: SlabTemplate
+        :param offset: (3,) translation, or (n, 3) for each adsorbate atom
+        :param ID: job ID
+        :param rotation: (3, 3) rotation matrix, upright if None
+        :param multiplicity: number of equivalent jobs the placement stands for,
+            the size of the symmetry orbit of its site or configuration
+        """
+        self.template = template
+        self.offset = np.asarray(offset, dtype=float)
+        self.ID = ID
+        self.rotation = rotation
+        self.multiplicity = multiplicity
+
+    def __len__(self):
+        return len(self.template)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.ID!r}, '
+                f'{self.template.adsorbate.get_chemical_formula()} at {self.offset.tolist()})')
+
+    @property
+    def adsorbate_positions(self) -> np.ndarray:
+        positions = self.template.adsorbate.positions
+        if self.rotation is not None:
+            positions = positions @ self.rotation.T
+        return positions + self.offset
+
+    @property
+    def numbers(self) -> np.ndarray:
+        return self.template.numbers
+
+    @property
+    def cell(self):
+        return self.template.slab.cell
+
+    @property
+    def constraints(self) -> list:
+        return self.template.slab.constraints
+
+    @property
+    def positions(self) -> np.ndarray:
+        """
+        Positions of slab + adsorbate, a new array is created on each call
+        """
+        return np.concatenate([self.template.slab.positions, self.adsorbate_positions])
+
+    def to_atoms(self) -> Atoms:
+        """
+        :return: new Atoms object of slab + adsorbate
+        """
+        ads = self.template.adsorbate.copy()
+        ads.positions = self.adsorbate_positions
+        return self.template.slab + ads
+
+
+def to_atoms(structure: Union[Atoms, Placement]) -> Atoms:
+    """
+    Returns the Atoms of a placement, Atoms are returned as they are
+    """
+    if isinstance(structure, Placement):
+        return structure.to_atoms()
+    return structure
@@ -2,18 +2,87 @@ import logging
 import re
 from argparse import ArgumentParser
 from configparser import ConfigParser
+from itertools import product
 from os import path
+from typing import Iterable, Iterator, List, Optional, Tuple
 
+import instrumentation
+from site_cache import DEFAULT_CACHE
 
 logger = logging.getLogger('curlywaddle')
 formatter = logging.Formatter('{levelname:8}:{filename}:{funcName}:{lineno}: {message}', style='{')
 
 
+def canonical_value(value):
+    """
+    Form of a setting that is the same for values that give the same input,
+    e.g. 520 and 520.0 or Auto and auto (INCAR values are case insensitive)
+    """
+    if isinstance(value, list):
+        return [canonical_value(v) for v in value]
+    if isinstance(value, str):
+        return value.lower()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+class Sweep:
+    """
+    Alternative values of a setting, separated by `|` in the configuration, e.g.
+    `sigma = 0.05 | 0.1 | 0.2`. Values that give the same input as an earlier
+    one are dropped, see `canonical_value`
+    """
+    def __init__(self, values: Iterable):
+        self.values = []
+        seen = []
+        for value in values:
+            if canonical_value(value) not in seen:
+                seen.append(canonical_value(value))
+                self.values.append(value)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.values!r})'
+
+
+def parse_value(text: str):
+    """
+    Parses an INCAR value, values with several words are returned as a list
+    """
+    vals = []
+    for v in re.split('\s*,?\s+', text.strip()):
+        if re.match('[-+]?\d+$', v):
+            v = int(v)
+        elif re.match('(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?$', v):
+            v = float(v)
+        # vasp incar uses `.` around booleans, e.g. .False.
+        elif v.lower().strip('. ') in ['yes', 'no', 'on', 'off', 'true', 'false', '1', '0']:
+            v = v.lower().strip('. ') in ('yes', 'on', 'true', '1')
+        vals.append(v)
+    if len(vals) == 1:
+        vals = vals[0]
+    return vals
+
+
+def parse_kpoints(text: str):
+    kpoints = [list(map(int, point.split()))
+               for point in text.strip().split('\n')]
+    if len(kpoints) == 1:
+        kpoints = kpoints[0]
+    return kpoints
+
+
 def parse_config(config) -> dict:
     """
     Parses information from configuration
     :param config: ConfigParser
-    :return: dict
+    :return: dict, settings swept over are Sweep objects
     """
     if config.getboolean('GENERAL', 'debug'):
         debug = 10
@@ -24,27 +93,21 @@ def parse_config(config) -> dict:
 
     # KPOINTS section
     kpts_text = config.get('GENERAL', 'kpoints')
-    kpoints = [list(map(int, point.split()))
-               for point in kpts_text.strip().split('\n')]
-    if len(kpoints) == 1:
-        kpoints = kpoints[0]
+    if '|' in kpts_text:
+        kpoints = Sweep(parse_kpoints(text) for text in kpts_text.split('|'))
+    else:
+        kpoints = parse_kpoints(kpts_text)
+
+    if '|' in xc:
+        xc = Sweep(text.strip() for text in xc.split('|'))
 
     # INCAR section
     incar = dict()
     for name, value in config['INCAR'].items():
-        vals = []
-        for v in re.split('\s*,?\s+', value):
-            if re.match('[-+]?\d+$', v):
-                v = int(v)
-            elif re.match('(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?$', v):
-                v = float(v)
-            # vasp incar uses `.` around booleans, e.g. .False.
-            elif v.lower().strip('. ') in ['yes', 'no', 'on', 'off', 'true', 'false', '1', '0']:
-                v = v.lower().strip('. ') in ('yes', 'on', 'true', '1')
-            vals.append(v)
-        if len(vals) == 1:
-            vals = vals[0]
-        incar[name] = vals
+        if '|' in value:
+            incar[name] = Sweep(parse_value(text) for text in value.split('|'))
+        else:
+            incar[name] = parse_value(value)
 
     res = dict(kpts=kpoints,
                xc=xc,
@@ -54,6 +117,12 @@ def parse_config(config) -> dict:
 
 
 def read_config(fname: str):
+    """
+    Reads the calculator settings of a campaign,
+    see `gen_settings` for the combinations of the sweeps
+    :param fname: configuration file
+    :return: dict
+    """
     defaults = dict(GENERAL={'debug': False,
                              'xc': 'pbe'})
 
@@ -64,26 +133,121 @@ def read_config(fname: str):
     return config
 
 
-def get_args(argv=''):
-    parser = ArgumentParser()
-    parser.add_argument('slab')
-    parser.add_argument('ads', nargs='?', default='O', choices=['O', 'OH'])
+def setting_label(name: str, value) -> str:
+    """
+    Label of a setting in the job IDs, e.g. `encut520` or `kpts5x5x1`
+    """
+    if isinstance(value, list):
+        value = 'x'.join(setting_label('', v) for v in value)
+    return f'{name}{value}'
+
+
+def gen_settings(config: dict) -> Iterator[Tuple[str, dict]]:
+    """
+    Every combination of the swept settings, generated lazily.
+    The values of each sweep give different inputs, so no two combinations do
+    :param config: Dict from `read_config`
+    :return: Tuple[ID, settings], e.g. ('encut520_sigma0.1', {...}),
+        the ID is empty if nothing is swept
+    """
+    names = swept_names(config)
+    for values in product(*(config[name] for name in names)):
+        settings = dict(config)
+        settings.update(zip(names, values))
+        ID = '_'.join(setting_label(name, value) for name, value in zip(names, values))
+        yield (ID, settings)
+
+
+def swept_names(config: dict) -> List[str]:
+    """
+    Names of the swept settings, in the order of the settings IDs
+    """
+    return sorted(name for name, value in config.items() if isinstance(value, Sweep))
+
+
+def find_settings(ID: str, config: dict) -> Optional[dict]:
+    """
+    Settings of the combination of `gen_settings` with this ID,
+    found without generating the other combinations
+    :param ID: settings ID, e.g. 'encut520_sigma0.1'
+    :param config: Dict from `read_config`
+    :return: Dict, None if no combination has this ID
+    """
+    settings = dict(config)
+    rest = ID
+    for name in swept_names(config):
+        for value in config[name]:
+            label = setting_label(name, value)
+            if rest == label or rest.startswith(label + '_'):
+                settings[name] = value
+                rest = rest[len(label) + 1:]
+                break
+        else:
+            return None
+    return settings if not rest else None
+
+
+def add_job_arguments(parser: ArgumentParser):
+    """
+    Arguments that set how the jobs of a campaign are generated and submitted
+    """
     parser.add_argument('-f', '--format')
-    parser.add_argument('-p', '--poscar_only', action='store_true',
-                        help='writes POSCAR only, does not run')
     parser.add_argument('-c', '--config', default='config.ini')
+    parser.add_argument('-s', '--symmetry', action='store_true',
+                        help='only one adsorption site per symmetry orbit')
+    parser.add_argument('--coverage', type=float,
+                        help='place several adsorbates per job, coverage in monolayers')
+    parser.add_argument('--min-dist', type=float, default=2.5,
+                        help='minimum distance between adsorbates with --coverage')
+    parser.add_argument('--orientations', type=int, nargs=2, metavar=('POLAR', 'AZIMUTHAL'),
+                        help='sample this many polar and azimuthal angles of the adsorbate '
+                             'on each site, orientations that clash with the slab are skipped')
+    parser.add_argument('--max-polar', type=float, default=90.,
+                        help='largest tilt of the adsorbate in degrees')
+    parser.add_argument('--site-cache', nargs='?', const=DEFAULT_CACHE,
+                        help='read the sites of surfaces enumerated before from this cache, '
+                             f'{DEFAULT_CACHE} if no file is given')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='maximum number of concurrent submissions')
+    parser.add_argument('--rate', type=float,
+                        help='maximum number of submissions per second')
+    parser.add_argument('--metrics',
+                        help='write counters and timings to this file at exit, '
+                             'Prometheus text format if it ends with .prom, JSON otherwise')
     parser.add_argument('--debug', action='store_true')
-    if argv:
-        if isinstance(argv, str):
-            argv = argv.split()
-        elif not hasattr(argv, '__iter__'):
-            raise TypeError(f'argv must be `str` or iterable, not {type(argv)}')
-        args = parser.parse_args(argv)
-    else:
-        # get arguments from terminal
-        args = parser.parse_args()
 
-    if args.debug:
+
+def add_campaign_arguments(parser: ArgumentParser):
+    """
+    Arguments shared by the commands that generate or submit the jobs of a campaign
+    """
+    parser.add_argument('slab', nargs='?')
+    parser.add_argument('ads', nargs='?', default='O', choices=['O', 'OH'])
+    add_job_arguments(parser)
+    parser.add_argument('-a', '--archive',
+                        help='zip archive with the POSCAR of all jobs, '
+                             'written with -p and read when submitting')
+    parser.add_argument('-m', '--manifest', default='jobs.sqlite',
+                        help='job manifest of the campaign')
+
+
+def parse_argv(parser: ArgumentParser, argv=''):
+    """
+    Parses `argv`, the arguments from the terminal are used if `argv` is an empty string
+    :param parser: ArgumentParser
+    :param argv: string emulating the command line arguments or list of arguments
+    :return: arguments Namespace
+    """
+    if isinstance(argv, str):
+        # get arguments from terminal if empty
+        argv = argv.split() or None
+    elif not hasattr(argv, '__iter__'):
+        raise TypeError(f'argv must be `str` or iterable, not {type(argv)}')
+    return parser.parse_args(argv)
+
+
+def setup_logging(debug: bool=False):
+    if debug:
         log_level = logging.DEBUG
     else:
         log_level = logging.INFO
@@ -94,9 +258,24 @@ def get_args(argv=''):
     fh.setLevel(logging.DEBUG)
     logger.addHandler(fh)
 
+
+def get_args(argv=''):
+    parser = ArgumentParser()
+    add_campaign_arguments(parser)
+    parser.add_argument('-p', '--poscar_only', action='store_true',
+                        help='writes POSCAR only, does not run')
+    parser.add_argument('--status', action='store_true',
+                        help='print the number of finished jobs from the manifest')
+    args = parse_argv(parser, argv)
+
+    setup_logging(args.debug)
     logger.debug(f'args:{vars(args)}')
+    if args.metrics:
+        instrumentation.enable(args.metrics)
 
-    if not args.poscar_only:
+    if not args.status:
+        assert args.slab, 'slab file is required'
+    if not (args.poscar_only or args.status):
         assert path.isfile(args.config), f'config: `{args.config}` must be an existing file'
 
     return args
@@ -1,29 +1,185 @@
 
+import json
 import logging
+import time
+from os import makedirs, path
 
+import numpy as np
 from ase.atoms import Atoms
+from ase.data import covalent_radii
+from ase.io import read, write
 
-from vasp import Vasp
-from vasp.exceptions import VaspQueued, VaspSubmitted
+from instrumentation import count, span
+from manifest import input_hash, structure_hash
+from outcar import finished_energy, read_results
+from submit import Scheduler, VaspScheduler
 
 logger = logging.getLogger('curlywaddly')
 
+default_config = dict(encut=400,
+                      isif=3,
+                      ibrion=2,
+                      ispin=2,
+                      lreal='Auto')
+# settings of the first DFT stage, loose enough to remove the large forces cheaply.
+# The cell is kept, the Pulay stress at the low cutoff would distort it
+low_precision_config = dict(prec='Low',
+                            isif=2,
+                            ediff=1e-4,
+                            ediffg=-0.1)
 
-def relax_struct(atoms: Atoms, config: dict):
-    default_config=dict(encut=400,
-                        isif=3,
-                        ibrion=2,
-                        ispin=2,
-                        lreal='Auto')
-    default_config.update(config)
-    calc = Vasp('init_relax', atoms=atoms, **config)
-    try:
-        energy = calc.potential_energy
-        print(energy)
-        state = 'initial relaxation complete'
-    except (VaspSubmitted, VaspQueued) as e:
-        logger.info(f"Couldn't get energy:\n{e}")
-        print(e)
-        state = 'initial relaxation running'
-
-    return state
+
+def classical_calculator(atoms: Atoms, name: str='emt'):
+    """
+    Cheap calculator for the pre-relaxation
+    :param atoms: Atoms, sets the length scale of the Lennard-Jones potential
+    :param name: 'emt', falls back to 'lj' if EMT has no parameters for an element
+    :return: ASE calculator
+    """
+    from ase.calculators.emt import EMT, parameters
+    from ase.calculators.lj import LennardJones
+
+    if name == 'emt' and set(atoms.get_chemical_symbols()) <= set(parameters):
+        return EMT()
+    if name == 'emt':
+        logger.info('EMT has no parameters for some elements, using Lennard-Jones')
+    elif name != 'lj':
+        raise ValueError(f'calculator "{name}" not recognized.')
+    # minimum at the typical bond length of the structure
+    bond = 2 * np.mean(covalent_radii[atoms.numbers])
+    sigma = bond / 2 ** (1 / 6)
+    return LennardJones(sigma=sigma, epsilon=0.1, rc=3 * sigma)
+
+
+def pre_relax(atoms: Atoms, calculator: str='emt', fmax: float=0.1,
+              steps: int=200) -> Atoms:
+    """
+    Relaxes the structure with a classical potential, constraints are kept
+    :param atoms: Atoms
+    :param calculator: see `classical_calculator`
+    :param fmax: force convergence criterion in eV/A
+    :param steps: maximum number of steps
+    :return: relaxed copy of the Atoms, its `info` has the number of steps
+    """
+    from ase.optimize import BFGS
+
+    atoms = atoms.copy()
+    atoms.calc = classical_calculator(atoms, calculator)
+    opt = BFGS(atoms, logfile=None)
+    opt.run(fmax=fmax, steps=steps)
+    relaxed = atoms.copy()
+    relaxed.info['steps'] = opt.get_number_of_steps()
+    relaxed.info['energy'] = atoms.get_potential_energy()
+    return relaxed
+
+
+def run_vasp(directory: str, atoms: Atoms, config: dict, finished: bool=False,
+             scheduler: Scheduler=None):
+    """
+    Runs a DFT stage
+    :param directory: directory of the stage
+    :param atoms: initial structure
+    :param config: calculator settings
+    :param finished: the stage finished before with the same settings,
+        it is read from its outputs without the calculator
+    :param scheduler: Scheduler, VaspScheduler if None
+    :return: Tuple[energy, relaxed Atoms], None if the stage is running
+    """
+    energy = finished_energy(directory) if finished else None
+    if energy is None:
+        scheduler = scheduler or VaspScheduler()
+        # the vasp calculator changes the working directory of its process
+        with scheduler.executor(1) as pool:
+            energy = pool.submit(scheduler.submit, directory, atoms, config).result()
+        if energy is None:
+            return None
+    return energy, read(path.join(directory, 'CONTCAR'), format='vasp')
+
+
+class StageTimes:
+    """
+    Time, number of steps, energy and input hash of each finished stage of a
+    relaxation, kept in a JSON file so the stages run in different invocations are compared
+    """
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.stages = dict()
+        if path.isfile(fname):
+            with open(fname) as f:
+                self.stages = json.load(f)
+
+    def same_inputs(self, stage: str, input_hash: str) -> bool:
+        """
+        Whether the stage finished before with the same inputs
+        """
+        return self.stages.get(stage, dict()).get('input_hash') == input_hash
+
+    def record(self, stage: str, **values):
+        self.stages[stage] = values
+        logger.info(f'{stage}: {values}')
+        with open(self.fname, 'w') as f:
+            json.dump(self.stages, f, indent=1)
+
+
+def relax_struct(atoms: Atoms, config: dict, directory: str='init_relax',
+                 calculator: str='emt', low_precision: bool=True, scheduler: Scheduler=None):
+    """
+    Relaxes a structure in stages, each one starting from the structure of the previous one:
+    a pre-relaxation with a classical potential, a low precision DFT relaxation
+    and the relaxation with the production settings.
+    DFT stages are submitted and the function returns while they run,
+    call it again to continue with the next stage.
+    The time, ionic steps and energy of each stage are written to `stages.json`
+    :param atoms: Atoms
+    :param config: calculator settings of the production stage
+    :param directory: directory of the production stage, the other stages are in subdirectories
+    :param calculator: classical calculator of the pre-relaxation, see
+        `classical_calculator`, no pre-relaxation if None
+    :param low_precision: run the low precision DFT stage
+    :param scheduler: Scheduler of the DFT stages, VaspScheduler if None
+    :return: state of the relaxation
+    """
+    config = dict(default_config, **config)
+    makedirs(directory, exist_ok=True)
+    times = StageTimes(path.join(directory, 'stages.json'))
+
+    if calculator:
+        pre_dir = path.join(directory, 'pre_relax')
+        fname = path.join(pre_dir, 'CONTCAR')
+        inputs = input_hash(dict(structure=structure_hash(atoms), calculator=calculator))
+        if not (path.isfile(fname) and times.same_inputs('pre_relax', inputs)):
+            start = time.perf_counter()
+            with span('relax.pre_relax'):
+                relaxed = pre_relax(atoms, calculator)
+            makedirs(pre_dir, exist_ok=True)
+            write(path.join(pre_dir, 'POSCAR'), atoms, format='vasp')
+            write(fname, relaxed, format='vasp')
+            times.record('pre_relax', time=time.perf_counter() - start,
+                         ionic_steps=relaxed.info['steps'], energy=relaxed.info['energy'],
+                         calculator=calculator, input_hash=inputs)
+        # read back on every call, so the DFT stages get the same structure each time
+        atoms = read(fname, format='vasp')
+
+    stages = [('production', directory, config)]
+    if low_precision:
+        low_config = dict(config, **low_precision_config)
+        stages.insert(0, ('low_precision', path.join(directory, 'low_precision'), low_config))
+
+    energy = None
+    for stage, stage_dir, stage_config in stages:
+        inputs = input_hash(dict(stage_config, structure=structure_hash(atoms)))
+        finished = times.same_inputs(stage, inputs)
+        result = run_vasp(stage_dir, atoms, stage_config, finished, scheduler)
+        if result is None:
+            count('relax', stage=stage, status='running')
+            return f'{stage.replace("_", " ")} relaxation running'
+        energy, atoms = result
+        if not finished:
+            outputs = read_results(stage_dir)
+            times.record(stage, time=outputs.get('elapsed'),
+                         ionic_steps=outputs.get('ionic_steps'), energy=energy,
+                         input_hash=inputs)
+        count('relax', stage=stage, status='finished')
+
+    logger.info(f'relaxed energy {energy}')
+    return 'initial relaxation complete'
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import sqlite3
+import time
+from os import makedirs, path
+from typing import List, Tuple
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+DEFAULT_CACHE = path.join(path.expanduser('~'), '.cache', 'curlywaddle', 'sites.sqlite')
+
+
+class SiteCache:
+    """
+    Persistent cache of the enumerated sites of a surface, shared by all the
+    campaigns of a user. Entries are evicted in least recently used order
+    once the cache is larger than `max_bytes`.
+    Several processes can use the same cache, SQLite serializes the writes
+    """
+    # bump when the enumeration changes so old entries are not used
+    version = 2
+
+    def __init__(self, fname: str=DEFAULT_CACHE, max_bytes: int=64 * 2**20,
+                 timeout: float=30.):
+        """
+        :param fname: SQLite file, its directory is created if needed
+        :param max_bytes: size limit of the cached sites
+        :param timeout: seconds to wait for another process holding a lock
+        """
+        directory = path.dirname(path.abspath(fname))
+        makedirs(directory, exist_ok=True)
+        self.fname = fname
+        self.max_bytes = max_bytes
+        # autocommit, transactions are opened explicitly
+        self.connection = sqlite3.connect(fname, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS sites (
+                                   key TEXT PRIMARY KEY,
+                                   data TEXT,
+                                   size INTEGER,
+                                   created REAL,
+                                   used REAL)''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT count(*) FROM sites').fetchone()[0]
+
+    def key(self, surface: str, **options) -> str:
+        """
+        :param surface: `auto.surface_key` of the slab
+        :param options: enumeration options, e.g. `cutoff_dist`
+        :return: hex digest
+        """
+        text = json.dumps(dict(surface=surface, version=self.version, **options),
+                          sort_keys=True, default=str)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def get(self, key: str) -> List[Tuple[str, List[float]]]:
+        """
+        Returns the cached sites, None if they are not in the cache
+        :return: list of (ID, position)
+        """
+        row = self.connection.execute('SELECT data FROM sites WHERE key = ?',
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute('UPDATE sites SET used = ? WHERE key = ?', (time.time(), key))
+        return [(ID, position) for ID, position in json.loads(row[0])]
+
+    def put(self, key: str, sites: List[Tuple[str, List[float]]]):
+        """
+        Stores the sites and evicts the least recently used entries if needed
+        :param key: see `key`
+        :param sites: list of (ID, position)
+        """
+        # floats are written with repr, positions are read back unchanged
+        data = json.dumps([(ID, [float(x) for x in position]) for ID, position in sites])
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.execute('INSERT OR REPLACE INTO sites VALUES (?, ?, ?, ?, ?)',
+                                    (key, data, len(data), now, now))
+            self.evict()
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits in `max_bytes`,
+        the last entry is always kept
+        """
+        total = self.connection.execute('SELECT coalesce(sum(size), 0) FROM sites').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.connection.execute('SELECT key, size FROM sites ORDER BY used').fetchall()
+        for key, size in rows[:-1]:
+            self.connection.execute('DELETE FROM sites WHERE key = ?', (key,))
+            total -= size
+            logger.debug(f'site cache: {key} evicted')
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        self.connection.execute('DELETE FROM sites')
@@ -0,0 +1,119 @@
+from collections import defaultdict
+from itertools import product
+from typing import Hashable, List, Tuple
+
+import numpy as np
+from numpy.linalg import norm
+
+
+class SiteIndex:
+    """
+    Periodic spatial hash of adsorption sites.
+    Sites are compared by their `xy` coordinates using the minimum image
+    convention of the surface cell, sites closer than `tol` are the same site
+    """
+    def __init__(self, cell, tol: float=0.05):
+        """
+        :param cell: cell of the surface, the first two vectors must lie in the xy plane
+        :param tol: distance tolerance in Angstrom
+        """
+        self.A = np.asarray(cell)[:2, :2]
+        self.inv = np.linalg.inv(self.A)
+        self.tol = tol
+        # bins are at least `tol` wide along each cell vector, so equal
+        # sites are always in neighboring bins
+        spacing = 1 / norm(self.inv, axis=0)
+        self.shape = tuple(int(n) for n in np.maximum(1, (spacing / tol).astype(int)))
+        self.bins = defaultdict(list)
+        self.keys = []
+        self.scaled = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, position):
+        return self.find(position) is not None
+
+    def _scale(self, position) -> np.ndarray:
+        return (np.asarray(position)[:2] @ self.inv) % 1
+
+    def _bin(self, scaled: np.ndarray) -> Tuple[int, int]:
+        return tuple(int(i) for i in (scaled * self.shape).astype(int) % self.shape)
+
+    def _distances(self, scaled: np.ndarray, indices) -> np.ndarray:
+        d = np.array([self.scaled[i] for i in indices]).reshape(-1, 2) - scaled
+        d -= np.round(d)
+        return norm(d @ self.A, axis=1)
+
+    def find(self, position) -> Hashable:
+        """
+        Returns the key of the site at `position` within `tol`, None if there is none
+        :param position: cartesian position, only `x` and `y` are used
+        :return: key
+        """
+        scaled = self._scale(position)
+        b = self._bin(scaled)
+        n0, n1 = self.shape
+        neighbor_bins = {((b[0] + i) % n0, (b[1] + j) % n1)
+                         for i, j in product((-1, 0, 1), repeat=2)}
+        candidates = [i for nb in neighbor_bins for i in self.bins.get(nb, ())]
+        if not candidates:
+            return None
+        d = self._distances(scaled, candidates)
+        k = np.argmin(d)
+        return self.keys[candidates[k]] if d[k] < self.tol else None
+
+    def add(self, position, key: Hashable=None) -> Hashable:
+        """
+        Adds a site to the index, duplicates are not checked
+        :param position: cartesian position, only `x` and `y` are used
+        :param key: key of the site, defaults to its insertion index
+        :return: key
+        """
+        if key is None:
+            key = len(self.keys)
+        scaled = self._scale(position)
+        self.bins[self._bin(scaled)].append(len(self.keys))
+        self.keys.append(key)
+        self.scaled.append(scaled)
+        return key
+
+    def memo(self, position, key: Hashable=None) -> bool:
+        """
+        Returns whether the site is already in the index, adds it otherwise
+        :param position: cartesian position, only `x` and `y` are used
+        :param key: key of the site if it is added
+        :return: bool
+        """
+        if position in self:
+            return True
+        self.add(position, key)
+        return False
+
+    def nearest(self, position) -> Tuple[Hashable, float]:
+        """
+        Returns the nearest site to `position`, at any distance
+        :param position: cartesian position, only `x` and `y` are used
+        :return: Tuple[key, distance]
+        """
+        if not self.keys:
+            raise ValueError('the index is empty')
+        scaled = self._scale(position)
+        d = self._distances(scaled, range(len(self.keys)))
+        k = np.argmin(d)
+        return self.keys[k], d[k]
+
+    def nearest_all(self, positions) -> Tuple[List[Hashable], np.ndarray]:
+        """
+        Nearest site to each position, computed for all the positions at once
+        :param positions: (m, 3) cartesian positions, only `x` and `y` are used
+        :return: Tuple[keys, (m,) distances]
+        """
+        if not self.keys:
+            raise ValueError('the index is empty')
+        scaled = (np.asarray(positions, dtype=float).reshape(-1, 3)[:, :2] @ self.inv) % 1
+        d = np.array(self.scaled)[None] - scaled[:, None]
+        d -= np.round(d)
+        distances = norm(d @ self.A, axis=2)
+        k = np.argmin(distances, axis=1)
+        return [self.keys[i] for i in k], distances[np.arange(len(k)), k]
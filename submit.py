@@ -0,0 +1,237 @@
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import count
+from typing import Callable, Iterable, Iterator, Tuple, Union
+
+from ase.atoms import Atoms
+
+from placement import Placement, to_atoms
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class Scheduler:
+    """
+    Backend used by `submit_all` to submit a job or get its result.
+    `submit` returns the energy of a finished job and None if the job is
+    submitted or queued. SchedulerError and OSError are considered transient
+    and the submission is retried, any other exception is raised by `submit_all`
+    """
+    # executor running `submit`, must be a concurrent.futures.Executor
+    executor = ThreadPoolExecutor
+
+    def submit(self, ID: str, atoms: Union[Atoms, Placement], config: dict) -> float:
+        raise NotImplementedError
+
+
+class VaspScheduler(Scheduler):
+    """
+    Submits the jobs through the `vasp` calculator
+    """
+    # the calculator changes the working directory, so each submission
+    # runs in its own process
+    executor = ProcessPoolExecutor
+
+    def submit(self, ID: str, atoms: Union[Atoms, Placement], config: dict) -> float:
+        from vasp import Vasp
+        from vasp.exceptions import VaspSubmitted, VaspQueued
+
+        calc = Vasp(ID, atoms=to_atoms(atoms), **config)
+        logger.info(f'calculator for {ID} created')
+        try:
+            logger.info(f'{ID}: getting potential energy')
+            return calc.potential_energy
+        except (VaspSubmitted, VaspQueued) as e:
+            logger.info(f"Couldn't get energy:\n{e}")
+            return None
+
+
+class LocalScheduler(Scheduler):
+    """
+    In memory scheduler for testing, a job finishes `runtime` seconds
+    after its first submission
+    """
+    def __init__(self, runtime: float=0., energy: Callable[[Atoms], float]=None,
+                 failures: int=0):
+        """
+        :param runtime: seconds each job takes to finish
+        :param energy: function returning the energy of a structure, 0 if None
+        :param failures: number of submissions that raise SchedulerError
+            before the scheduler starts accepting jobs
+        """
+        self.runtime = runtime
+        self.energy = energy or (lambda atoms: 0.)
+        self.failures = failures
+        self.submitted = dict()
+        self.lock = threading.Lock()
+
+    def submit(self, ID: str, atoms: Atoms, config: dict) -> float:
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise SchedulerError(f'{ID}: submission failed')
+            if ID not in self.submitted:
+                self.submitted[ID] = time.monotonic()
+                return None
+            if time.monotonic() - self.submitted[ID] < self.runtime:
+                return None
+        return self.energy(atoms)
+
+
+class LocalFileScheduler(Scheduler):
+    """
+    Fake VASP runner for testing, writes the INCAR and POSCAR of a job in its
+    directory when it is submitted and the CONTCAR, OSZICAR and OUTCAR
+    of a finished job `runtime` seconds later
+    """
+    def __init__(self, runtime: float=0., energy: Callable[[Atoms], float]=None):
+        """
+        :param runtime: seconds each job takes to finish
+        :param energy: function returning the energy of a structure, 0 if None
+        """
+        self.runtime = runtime
+        self.energy = energy or (lambda atoms: 0.)
+        self.timers = []
+
+    def submit(self, ID: str, atoms: Union[Atoms, Placement], config: dict) -> float:
+        from ase.io import write
+        from outcar import finished_energy
+
+        energy = finished_energy(ID)
+        if energy is not None:
+            return energy
+        atoms = to_atoms(atoms)
+        os.makedirs(ID, exist_ok=True)
+        write(os.path.join(ID, 'POSCAR'), atoms, format='vasp')
+        with open(os.path.join(ID, 'INCAR'), 'w') as f:
+            f.writelines(f'{key.upper()} = {value}\n' for key, value in config.items())
+        timer = threading.Timer(self.runtime, self.finish, (ID, atoms, config))
+        timer.start()
+        self.timers.append(timer)
+        return None
+
+    def finish(self, ID: str, atoms: Atoms, config: dict):
+        from ase.io import write
+
+        energy = self.energy(atoms)
+        nsw = config.get('nsw', 0)
+        write(os.path.join(ID, 'CONTCAR'), atoms, format='vasp')
+        with open(os.path.join(ID, 'OSZICAR'), 'w') as f:
+            f.write(f'   1 F= {energy:.8E} E0= {energy:.8E}  d E =0.0\n')
+        lines = [f'   NSW    =    {nsw}    number of steps for IOM',
+                 f' {"-" * 39} Iteration      1(   1)  {"-" * 39}',
+                 f'  free  energy   TOTEN  =    {energy:14.8f} eV',
+                 f'  energy  without entropy=    {energy:14.8f}  energy(sigma->0) =    {energy:14.8f}']
+        if nsw > 1:
+            lines.append(' reached required accuracy - stopping structural energy minimisation')
+        lines += [' General timing and accounting informations for this job:',
+                  f'                  Elapsed time (sec):    {self.runtime:10.3f}']
+        with open(os.path.join(ID, 'OUTCAR'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def join(self):
+        """
+        Waits for the jobs submitted so far to finish
+        """
+        for timer in self.timers:
+            timer.join()
+
+
+class RateLimiter:
+    """
+    Allows at most `rate` calls to `wait` per second, no limit if `rate` is None
+    """
+    def __init__(self, rate: float=None):
+        self.interval = 1 / rate if rate else 0.
+        self.next_time = 0.
+
+    def wait(self):
+        now = time.monotonic()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+            now = self.next_time
+        self.next_time = now + self.interval
+
+
+def submit_all(scheduler: Scheduler, jobs: Iterable[Tuple[str, Atoms]], config: dict,
+               max_workers: int=4, rate: float=None, retries: int=3,
+               backoff: float=1.) -> Iterator[Tuple[str, float, Exception]]:
+    """
+    Submits the jobs concurrently
+    :param scheduler: Scheduler
+    :param jobs: iterable of (ID, Atoms or Placement) or (ID, structure, settings),
+        the settings of a job replace `config`
+    :param config: calculator settings
+    :param max_workers: maximum number of concurrent submissions
+    :param rate: maximum number of submissions per second
+    :param retries: number of times a submission that failed with a
+        SchedulerError or OSError is retried, other errors are raised right away
+    :param backoff: seconds before the first retry, doubled on each retry
+    :return: Tuple[ID, energy or None, error], in order of completion. The energy
+        is None for a job submitted or queued, the error is None unless the
+        submission still failed after `retries` retries
+    """
+    limiter = RateLimiter(rate)
+    jobs = iter(jobs)
+    running = dict()
+    # heap of (time, seq, ID, atoms, attempt, settings) of the submissions to retry
+    delayed = []
+    seq = count()
+    exhausted = False
+
+    with scheduler.executor(max_workers) as pool:
+        def launch(ID, atoms, attempt, settings=config):
+            limiter.wait()
+            future = pool.submit(scheduler.submit, ID, atoms, settings)
+            running[future] = (ID, atoms, attempt, settings)
+
+        while True:
+            while len(running) < max_workers:
+                if delayed and delayed[0][0] <= time.monotonic():
+                    _, _, ID, atoms, attempt, settings = heapq.heappop(delayed)
+                    launch(ID, atoms, attempt, settings)
+                elif not exhausted:
+                    try:
+                        ID, atoms, *settings = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                        continue
+                    launch(ID, atoms, 0, *settings)
+                else:
+                    break
+
+            timeout = max(0., delayed[0][0] - time.monotonic()) if delayed else None
+            if not running:
+                if timeout is None:
+                    break
+                time.sleep(timeout)
+                continue
+
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                ID, atoms, attempt, settings = running.pop(future)
+                try:
+                    energy = future.result()
+                except (SchedulerError, OSError) as e:
+                    if attempt < retries:
+                        delay = backoff * 2 ** attempt
+                        logger.warning(f'{ID}: submission failed, retrying in {delay} s\n{e}')
+                        heapq.heappush(delayed, (time.monotonic() + delay, next(seq),
+                                                 ID, atoms, attempt + 1, settings))
+                    else:
+                        logger.error(f'{ID}: submission failed after {retries} retries\n{e}')
+                        yield (ID, None, e)
+                except Exception as e:
+                    logger.error(f'{ID}: submission failed\n{e}')
+                    raise
+                else:
+                    yield (ID, energy, None)
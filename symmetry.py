@@ -0,0 +1,78 @@
+from itertools import product
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+from ase.atoms import Atoms
+from numpy.linalg import norm
+
+from sites import SiteIndex
+
+import logging
+
+logger = logging.getLogger('curlywaddly')
+
+
+def get_symmetry_operations(slab: Atoms, tol: float=0.1) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Finds the 2D space group operations of the slab, i.e. the operations
+    that keep the surface normal and map every atom onto an atom of the
+    same element at the same height.
+    Operations act on scaled `xy` coordinates as `f' = rotation @ f + translation`
+    :param slab: Atoms, the first two cell vectors must lie in the xy plane
+    :param tol: distance tolerance in Angstrom
+    :return: list of (rotation, translation) pairs
+    """
+    A = slab.cell[:2, :2]
+    metric = A @ A.T
+    scaled = slab.positions[:, :2] @ np.linalg.inv(A)
+    z = slab.positions[:, 2]
+    symbols = np.array(slab.get_chemical_symbols())
+    equivalent = (symbols[:, None] == symbols[None]) & (abs(z[:, None] - z[None]) < tol)
+
+    operations = []
+    for entries in product((-1, 0, 1), repeat=4):
+        rotation = np.reshape(entries, (2, 2))
+        if abs(np.linalg.det(rotation)) != 1 \
+                or not np.allclose(rotation.T @ metric @ rotation, metric, atol=tol):
+            continue
+        images = scaled @ rotation.T
+        # the image of the first atom must be one of its equivalent atoms
+        for j in np.nonzero(equivalent[0])[0]:
+            translation = scaled[j] - images[0]
+            d = images[:, None] + translation - scaled[None]
+            d -= np.round(d)
+            match = (norm(d @ A, axis=2) < tol) & equivalent
+            if match.any(axis=1).all():
+                operations.append((rotation, translation % 1))
+    logger.debug(f'{len(operations)} symmetry operations found')
+    return operations
+
+
+def gen_unique_sites(slab: Atoms, sites: Iterable[Tuple[str, np.ndarray]],
+                     tol: float=0.1) -> Iterator[Tuple[str, np.ndarray, int]]:
+    """
+    Keeps the first site of each symmetry orbit, sites are compared by
+    their `xy` coordinates
+    :param slab: Atoms the sites belong to
+    :param sites: iterable of (ID, position)
+    :param tol: distance tolerance in Angstrom
+    :return: Tuple[ID, position, multiplicity]
+    """
+    operations = get_symmetry_operations(slab, tol)
+    A = slab.cell[:2, :2]
+    inv = np.linalg.inv(A)
+    # every image of the representatives found so far
+    known = SiteIndex(slab.cell, tol)
+
+    for ID, position in sites:
+        if position in known:
+            continue
+
+        scaled = position[:2] @ inv
+        orbit = SiteIndex(slab.cell, tol)
+        for rotation, translation in operations:
+            image = (rotation @ scaled + translation) @ A
+            if not orbit.memo(image):
+                known.add(image, ID)
+
+        yield (ID, position, len(orbit))
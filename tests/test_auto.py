@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from ase.build import fcc100, fcc111, fcc211
+
+from auto import gen_midpoints, get_sites, surface_key
+
+
+def test_surface_key_atom_order():
+    slab = fcc111('Pt', (3, 3, 4), vacuum=6)
+    order = np.random.default_rng(0).permutation(len(slab))
+    shifted = slab.copy()
+    shifted.translate(slab.cell[0] - slab.cell[1])
+    assert surface_key(slab) == surface_key(slab[order]) == surface_key(shifted)
+
+
+def test_surface_key_geometry():
+    slab = fcc111('Pt', (3, 3, 4), vacuum=6)
+    moved = slab.copy()
+    moved.positions[-1] += (0.1, 0, 0)
+    other = slab.copy()
+    other.symbols[-1] = 'Cu'
+    # the elements don't change the sites
+    assert surface_key(other) == surface_key(slab)
+    assert surface_key(moved) != surface_key(slab)
+
+
+def test_site_ids_atom_order():
+    slab = fcc111('Pt', (2, 2, 3), vacuum=6)
+    slab.symbols[[1, 4, 9]] = 'Cu'
+    # e.g. a POSCAR written with `sort`
+    shuffled = slab[np.argsort(slab.get_chemical_symbols(), kind='stable')]
+    sites = dict(get_sites(slab))
+    for ID, position in get_sites(shuffled):
+        assert np.allclose(position, sites[ID])
+
+
+@pytest.mark.parametrize('slab', [fcc111('Pt', (2, 2, 3), vacuum=6),
+                                  fcc100('Pt', (2, 2, 3), vacuum=6),
+                                  fcc211('Pt', (3, 2, 3), vacuum=6)],
+                         ids=['fcc111', 'fcc100', 'fcc211'])
+def test_graph_sites(slab):
+    graph = list(gen_midpoints(slab, method='graph'))
+    combinations = list(gen_midpoints(slab, method='combinations'))
+    assert [ID for ID, _ in graph] == [ID for ID, _ in combinations]
+    assert np.allclose([pos for _, pos in graph], [pos for _, pos in combinations])
+
+
+def test_boundary_bridges():
+    slab = fcc111('Pt', (2, 2, 3), vacuum=6)
+    bridges = [pos for ID, pos in gen_midpoints(slab) if ID.startswith('2_')]
+    scaled = np.round(slab.cell.scaled_positions(np.array(bridges))[:, :2], 3) % 1
+    assert len(bridges) == 11
+    # the bridges on the a = 0 edge of the cell, missed before the sites were
+    # classified with a tolerance on the cell boundary
+    assert {(0., 0.25), (0., 0.75)} <= set(map(tuple, scaled))
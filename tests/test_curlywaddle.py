@@ -0,0 +1,52 @@
+import sqlite3
+
+from ase.atoms import Atoms
+from ase.build import fcc111
+
+from curlywaddle import run_all
+from manifest import JobManifest
+from submit import LocalScheduler, SchedulerError
+
+
+class FailingJob(LocalScheduler):
+    """
+    Every attempt to submit the job `failing` fails
+    """
+    def __init__(self, failing: str, manifest: str):
+        super().__init__()
+        self.failing = failing
+        self.manifest = manifest
+        # number of jobs recorded as submitted seen by another reader at each submission
+        self.seen = []
+
+    def submit(self, ID, atoms, config):
+        if ID == self.failing:
+            raise SchedulerError(f'{ID}: queue full')
+        with sqlite3.connect(self.manifest) as connection:
+            self.seen.append(connection.execute(
+                "SELECT count(*) FROM jobs WHERE status = 'submitted'").fetchone()[0])
+        return super().submit(ID, atoms, config)
+
+
+def statuses(fname: str) -> dict:
+    with JobManifest(fname) as manifest:
+        return {job['id']: job['status'] for job in manifest.jobs()}
+
+
+def test_failed_submission(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    slab = fcc111('Pt', (2, 2, 3), vacuum=6)
+    scheduler = FailingJob('1_0', 'jobs.sqlite')
+    state = run_all(slab, Atoms('O'), dict(), scheduler=scheduler, max_workers=1,
+                    retries=0, symmetry=True, commit_interval=0)
+    assert state == '0/4 jobs finished, 1 failed to submit: 1_0'
+    jobs = statuses('jobs.sqlite')
+    assert jobs == {'1_0': 'failed', '2_0': 'submitted', '3_0': 'submitted',
+                    '3_1': 'submitted'}
+    # committed while submitting
+    assert scheduler.seen[-1] > 0
+
+    # submitted again by the next run
+    scheduler.failing = None
+    run_all(slab, Atoms('O'), dict(), scheduler=scheduler, retries=0, symmetry=True)
+    assert statuses('jobs.sqlite')['1_0'] == 'submitted'
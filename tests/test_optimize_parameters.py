@@ -0,0 +1,123 @@
+from math import exp
+
+import pytest
+
+from optimize_parameters import converge, converge_grid, grid_cost
+
+
+def decaying(c: float=-10., a: float=5., b: float=0.02):
+    """
+    Synthetic energy that converges like c + a*exp(-b*x)
+    """
+    calls = []
+
+    def energy(x):
+        calls.append(x)
+        return c + a * exp(-b * x)
+    return energy, calls
+
+
+def first_converged(b, start, step, threshold):
+    """
+    Smallest value converged by a linear scan
+    """
+    energy, _ = decaying(b=b)
+    i = 0
+    while abs(energy(start + i * step) - energy(start + (i + 1) * step)) >= threshold:
+        i += 1
+    return start + i * step
+
+
+@pytest.mark.parametrize('start, step, b', [(250, 50, 0.02), (0.1, 0.1, 8.), (2, 0.3, 1.5)])
+def test_converge(start, step, b):
+    energy, calls = decaying(b=b)
+    value, energies = converge(energy, start, step, threshold=1e-3, max_iterations=30)
+    expected = first_converged(b, start, step, 1e-3)
+    assert value == pytest.approx(expected)
+    assert len(calls) == len(set(calls)) == len(energies)
+    # fewer calculations than scanning linearly up to the converged pair
+    assert len(energies) < round((expected - start) / step) + 2
+
+
+@pytest.mark.parametrize('step', [0.05, 0.15])
+def test_non_integer_step(step):
+    # 0.1 + 0.05 + 0.05 != 0.1 + 2*0.05, each value of the grid must be calculated once
+    energy, calls = decaying(b=8.)
+    value, energies = converge(energy, 0.1, step, threshold=1e-3, max_iterations=30)
+    assert value == pytest.approx(first_converged(8., 0.1, step, 1e-3))
+    indices = {round((x - 0.1) / step) for x in calls}
+    assert len(indices) == len(calls) == len(energies)
+
+
+def test_not_converged():
+    energy, calls = decaying(b=1e-4)
+    value, energies = converge(energy, 100, 10, threshold=1e-6, max_iterations=5)
+    assert len(energies) == 5
+    assert value == max(energies)
+
+
+@pytest.mark.parametrize('max_iterations', [0, -1])
+def test_no_iterations(max_iterations):
+    energy, calls = decaying()
+    with pytest.raises(ValueError):
+        converge(energy, 250, 50, max_iterations=max_iterations)
+    assert not calls
+
+
+def test_single_iteration():
+    energy, calls = decaying()
+    value, energies = converge(energy, 250, 50, max_iterations=1)
+    assert (value, energies) == (250, {250: energy(250)})
+
+
+def grid_energy(encut, kpoints):
+    return -10 + 5 * exp(-0.02 * encut) + 2 * exp(-kpoints)
+
+
+def test_converge_grid():
+    encuts, kpoints = list(range(250, 601, 50)), list(range(2, 10))
+    calls = []
+
+    def energy(encut, k):
+        calls.append((encut, k))
+        return grid_energy(encut, k)
+
+    best, results = converge_grid(energy, encuts, kpoints, threshold=1e-2, max_workers=1)
+
+    def neighbors(encut, k):
+        return {(encut, k), (encut + 50, k), (encut, k + 1)}
+
+    def converged(encut, k):
+        return all(abs(grid_energy(encut, k) - grid_energy(*p)) < 1e-2
+                   for p in neighbors(encut, k))
+
+    candidates = sorted(((encut, k) for encut in encuts[:-1] for k in kpoints[:-1]),
+                        key=lambda c: grid_cost(*c))
+    expected = next(c for c in candidates if converged(*c))
+    assert best == expected
+    # only the points of the candidates up to the converged one are calculated, once
+    cheaper = candidates[:candidates.index(expected) + 1]
+    assert len(calls) == len(set(calls)) == len(results)
+    assert set(calls) == set().union(*(neighbors(*c) for c in cheaper))
+    assert len(calls) < len(set().union(*(neighbors(*c) for c in candidates)))
+
+
+def test_converge_grid_workers():
+    encuts, kpoints = list(range(250, 601, 50)), list(range(2, 10))
+    serial, _ = converge_grid(grid_energy, encuts, kpoints, threshold=1e-2, max_workers=1)
+    assert converge_grid(grid_energy, encuts, kpoints, threshold=1e-2)[0] == serial
+
+
+def test_converge_grid_known_points():
+    # the points of (1, 1) are calculated by the cheaper candidates and converged
+    def energy(encut, k):
+        calls.append((encut, k))
+        return 0. if (encut, k) in {(1, 1), (2, 1), (1, 2)} else 10 * encut + 3 * k + 1
+
+    calls = []
+    # (1, 1) is the last candidate of cost 2
+    best, results = converge_grid(energy, range(4), range(4), threshold=1e-2, max_workers=1,
+                                  cost=lambda encut, k: encut + k + 0.5 * (encut == k))
+    assert best == (1, 1)
+    assert set(calls) == {(0, 0), (1, 0), (0, 1), (1, 1), (0, 2), (2, 0),
+                          (1, 2), (0, 3), (2, 1), (3, 0)}
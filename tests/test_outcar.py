@@ -0,0 +1,50 @@
+from outcar import FINISHED, read_outcar, read_results
+
+
+def write_outcar(fname, nsw: int, steps: int, converged: bool, finished: bool=True,
+                 padding: int=0):
+    lines = [f'   NSW    =    {nsw}    number of steps for IOM']
+    for step in range(1, steps + 1):
+        lines += [f' {"-" * 39} Iteration {step:6d}(   1)  {"-" * 39}',
+                  ' ' * padding,
+                  f'  free  energy   TOTEN  =    {-10 - step:14.8f} eV',
+                  f'  energy  without entropy=    {-10 - step:14.8f}  '
+                  f'energy(sigma->0) =    {-10.5 - step:14.8f}']
+    if converged:
+        lines.append(' reached required accuracy - stopping structural energy minimisation')
+    if finished:
+        lines += [f' {FINISHED.decode()}:', '                  Elapsed time (sec):      12.345']
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def test_relaxation(tmp_path):
+    fname = tmp_path / 'OUTCAR'
+    write_outcar(fname, nsw=100, steps=3, converged=True, padding=2**17)
+    results = read_outcar(str(fname))
+    assert results == dict(energy=-13.5, free_energy=-13., ionic_steps=3, finished=True,
+                           converged=True, elapsed=12.345)
+
+
+def test_unconverged(tmp_path):
+    fname = tmp_path / 'OUTCAR'
+    write_outcar(fname, nsw=3, steps=3, converged=False)
+    results = read_outcar(str(fname))
+    assert results['finished'] and not results['converged']
+
+
+def test_single_point(tmp_path):
+    fname = tmp_path / 'OUTCAR'
+    write_outcar(fname, nsw=0, steps=1, converged=False)
+    assert read_outcar(str(fname))['converged']
+
+
+def test_running(tmp_path):
+    write_outcar(tmp_path / 'OUTCAR', nsw=100, steps=2, converged=False, finished=False)
+    results = read_results(str(tmp_path))
+    assert results['energy'] == -12.5
+    assert not results['finished'] and results['elapsed'] is None
+
+
+def test_no_outputs(tmp_path):
+    assert read_results(str(tmp_path)) == dict()
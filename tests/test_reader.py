@@ -0,0 +1,33 @@
+from reader import Sweep, find_settings, gen_settings
+
+
+def test_sweep_same_inputs():
+    assert list(Sweep([520, 520.0, 600])) == [520, 600]
+    assert list(Sweep(['Auto', 'auto', '.FALSE.'])) == ['Auto', '.FALSE.']
+    assert list(Sweep([[5, 5, 1], [5.0, 5, 1], [7, 7, 1]])) == [[5, 5, 1], [7, 7, 1]]
+
+
+def test_gen_settings():
+    config = dict(encut=Sweep([520, 520.0, 600]), lreal=Sweep(['Auto', 'auto']),
+                  sigma=Sweep([0.05, 0.1]), ismear=1)
+    combinations = list(gen_settings(config))
+    assert [ID for ID, settings in combinations] == [
+        'encut520_lrealAuto_sigma0.05', 'encut520_lrealAuto_sigma0.1',
+        'encut600_lrealAuto_sigma0.05', 'encut600_lrealAuto_sigma0.1']
+    assert combinations[1][1] == dict(encut=520, lreal='Auto', sigma=0.1, ismear=1)
+
+
+def test_find_settings():
+    config = dict(encut=Sweep([52, 520]), kpoints=Sweep([[5, 5, 1], [7, 7, 1]]), ismear=1)
+    for ID, settings in gen_settings(config):
+        assert find_settings(ID, config) == settings
+    assert find_settings('encut52', config) is None
+    assert find_settings('encut600_kpoints5x5x1', config) is None
+    assert find_settings('encut52_kpoints5x5x1_sigma0.1', config) is None
+
+
+def test_nothing_swept():
+    config = dict(encut=520)
+    assert list(gen_settings(config)) == [('', config)]
+    assert find_settings('', config) == config
+    assert find_settings('encut520', config) is None
@@ -0,0 +1,129 @@
+import time
+
+import pytest
+from ase.atoms import Atoms
+
+from submit import LocalScheduler, RateLimiter, Scheduler, SchedulerError, submit_all
+
+
+def make_jobs(n: int):
+    return [(f'job{i}', Atoms('H', positions=[(0, 0, i)])) for i in range(n)]
+
+
+def energies(results) -> dict:
+    """
+    Dict[ID, energy] of the jobs submitted without error
+    """
+    return {ID: energy for ID, energy, error in results if error is None}
+
+
+class BrokenScheduler(Scheduler):
+    """
+    Scheduler whose submissions fail with a non transient error
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def submit(self, ID, atoms, config):
+        self.calls += 1
+        raise ValueError(f'{ID}: bad input')
+
+
+def test_submit_and_finish():
+    scheduler = LocalScheduler(energy=lambda atoms: -atoms.positions[0, 2])
+    jobs = make_jobs(5)
+    assert energies(submit_all(scheduler, jobs, dict())) == {ID: None for ID, _ in jobs}
+    # finished on the next submission
+    results = energies(submit_all(scheduler, jobs, dict()))
+    assert results == {f'job{i}': -i for i in range(5)}
+
+
+def test_running_jobs():
+    scheduler = LocalScheduler(runtime=60)
+    jobs = make_jobs(3)
+    list(submit_all(scheduler, jobs, dict()))
+    assert all(energy is None and error is None
+               for _, energy, error in submit_all(scheduler, jobs, dict()))
+
+
+def test_retry():
+    scheduler = LocalScheduler(failures=3)
+    jobs = make_jobs(2)
+    results = energies(submit_all(scheduler, jobs, dict(), max_workers=1, retries=3,
+                                  backoff=0.01))
+    assert set(results) == {'job0', 'job1'}
+    assert set(scheduler.submitted) == {'job0', 'job1'}
+    assert scheduler.failures == 0
+
+
+def test_retries_exhausted(caplog):
+    scheduler = LocalScheduler(failures=10)
+    results = list(submit_all(scheduler, make_jobs(1), dict(), retries=2, backoff=0.01))
+    [(ID, energy, error)] = results
+    assert (ID, energy) == ('job0', None)
+    assert isinstance(error, SchedulerError)
+    # first attempt and two retries
+    assert scheduler.failures == 7
+    assert not scheduler.submitted
+    assert 'failed after 2 retries' in caplog.text
+
+
+def test_failure_reported():
+    class FailingJob(LocalScheduler):
+        """ every attempt to submit job0 fails """
+        def submit(self, ID, atoms, config):
+            if ID == 'job0':
+                raise SchedulerError(f'{ID}: queue full')
+            return super().submit(ID, atoms, config)
+
+    results = {ID: (energy, error) for ID, energy, error in
+               submit_all(FailingJob(), make_jobs(2), dict(), retries=1, backoff=0.01)}
+    energy, error = results['job0']
+    assert energy is None and str(error) == 'job0: queue full'
+    # submitted to the queue
+    assert results['job1'] == (None, None)
+
+
+def test_backoff():
+    scheduler = LocalScheduler(failures=2)
+    start = time.monotonic()
+    list(submit_all(scheduler, make_jobs(1), dict(), retries=2, backoff=0.05))
+    # 0.05 s then 0.1 s
+    assert time.monotonic() - start >= 0.15
+
+
+def test_not_retried():
+    scheduler = BrokenScheduler()
+    with pytest.raises(ValueError, match='bad input'):
+        list(submit_all(scheduler, make_jobs(1), dict(), retries=3, backoff=0.01))
+    assert scheduler.calls == 1
+
+
+def test_rate_limit():
+    scheduler = LocalScheduler()
+    start = time.monotonic()
+    results = list(submit_all(scheduler, make_jobs(5), dict(), rate=20))
+    assert len(results) == 5
+    # the first submission doesn't wait
+    assert time.monotonic() - start >= 4 / 20
+
+
+def test_rate_limiter():
+    limiter = RateLimiter()
+    start = time.monotonic()
+    for _ in range(100):
+        limiter.wait()
+    assert time.monotonic() - start < 0.05
+
+
+def test_settings_per_job():
+    class Recorder(LocalScheduler):
+        def submit(self, ID, atoms, config):
+            configs[ID] = config
+            return super().submit(ID, atoms, config)
+
+    configs = dict()
+    jobs = [(ID, atoms, dict(encut=500)) for ID, atoms in make_jobs(2)] + make_jobs(3)[2:]
+    list(submit_all(Recorder(), jobs, dict(encut=400)))
+    assert configs == {'job0': dict(encut=500), 'job1': dict(encut=500),
+                       'job2': dict(encut=400)}
@@ -0,0 +1,105 @@
+import csv
+
+import pytest
+from ase.build import fcc111
+
+from manifest import JobManifest
+from submit import LocalFileScheduler, submit_all
+from watcher import AdsorptionEnergies, SinglePoint, Stage, watch
+
+
+def energy(atoms):
+    # the single points differ from the relaxations
+    return -1. - atoms.positions[-1, 2] / 100
+
+
+@pytest.fixture
+def campaign(tmp_path, monkeypatch):
+    """
+    Three relaxations submitted to a LocalFileScheduler
+    """
+    monkeypatch.chdir(tmp_path)
+    slab = fcc111('Pt', (1, 1, 2), vacuum=5)
+    jobs = []
+    for i in range(3):
+        atoms = slab.copy()
+        atoms.positions[-1, 2] += 0.1 * i
+        jobs.append((f'1_{i}', atoms))
+    scheduler = LocalFileScheduler(runtime=0.2, energy=energy)
+    with JobManifest('jobs.sqlite') as manifest:
+        for ID, toten, error in submit_all(scheduler, jobs, dict(nsw=100)):
+            manifest.update(ID, 'submitted', toten)
+    return scheduler, dict(jobs)
+
+
+def test_watch(campaign):
+    scheduler, jobs = campaign
+    single_points = LocalFileScheduler(runtime=0.2, energy=lambda atoms: energy(atoms) - 1)
+    stages = [SinglePoint(dict(encut=400), single_points),
+              AdsorptionEnergies(-3., -0.5, stage='single_point')]
+    state = watch('jobs.sqlite', stages, interval=0.05, timeout=10)
+    assert state == '6/6 jobs finished'
+
+    with JobManifest('jobs.sqlite') as manifest:
+        statuses = {job['id']: job['status'] for job in manifest.jobs()}
+        assert statuses == {ID: 'finished' for ID in
+                            ['1_0', '1_1', '1_2',
+                             '1_0/single_point', '1_1/single_point', '1_2/single_point']}
+        for ID, atoms in jobs.items():
+            assert manifest.get(f'{ID}/single_point')['energy'] == \
+                pytest.approx(energy(atoms) - 1)
+
+    # one executor for all the single points, shut down when the watcher returns
+    assert stages[0].pool is None
+
+    with open('1_0/single_point/INCAR') as f:
+        assert set(f.read().split('\n')) >= {'ENCUT = 400', 'IBRION = -1', 'NSW = 0'}
+    with open('adsorption.csv') as f:
+        # one row per job, in the order they finished
+        rows = sorted(csv.DictReader(f), key=lambda row: row['job'])
+    assert [row['job'] for row in rows] == ['1_0/single_point', '1_1/single_point',
+                                            '1_2/single_point']
+    for row, atoms in zip(rows, jobs.values()):
+        assert float(row['energy']) == pytest.approx(energy(atoms) - 1)
+        assert float(row['adsorption_energy']) == pytest.approx(energy(atoms) - 1 + 3. + 0.5)
+
+
+class CountingScheduler(LocalFileScheduler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executors = []
+
+    def executor(self, max_workers):
+        pool = super().executor(max_workers)
+        self.executors.append(pool)
+        return pool
+
+
+def test_single_point_executor(campaign):
+    single_points = CountingScheduler(runtime=0.01, energy=energy)
+    stage = SinglePoint(dict(encut=400), single_points)
+    assert watch('jobs.sqlite', [stage], interval=0.05, timeout=10) == '6/6 jobs finished'
+    assert len(single_points.executors) == 1
+    assert single_points.executors[0]._shutdown
+    assert stage.pool is None
+
+
+def test_timeout(campaign):
+    scheduler, jobs = campaign
+    assert watch('jobs.sqlite', interval=0.05, timeout=0.01) == '0/3 jobs finished'
+    scheduler.join()
+    assert watch('jobs.sqlite', interval=0.05, timeout=10) == '3/3 jobs finished'
+
+
+class BrokenStage(Stage):
+    def run(self, ID, results, energies):
+        if ID == '1_1':
+            raise FileNotFoundError(f'{ID}/CONTCAR')
+        return []
+
+
+def test_failed_stage(campaign):
+    state = watch('jobs.sqlite', [BrokenStage()], interval=0.05, timeout=10)
+    assert state == '2/3 jobs finished'
+    with JobManifest('jobs.sqlite') as manifest:
+        assert manifest.get('1_1')['status'] == 'failed'
@@ -0,0 +1,72 @@
+from io import StringIO
+
+import numpy as np
+import pytest
+from ase.atoms import Atoms
+from ase.build import fcc111
+from ase.constraints import FixAtoms, FixScaled
+from ase.io import read, write
+
+from writers import PoscarWriter
+
+
+def constrained_slab() -> Atoms:
+    slab = fcc111('Pt', (2, 2, 3), vacuum=5)
+    slab.set_constraint(FixAtoms(indices=[atom.index for atom in slab if atom.tag == 3]))
+    return slab
+
+
+def read_poscar(text: str) -> Atoms:
+    return read(StringIO(text), format='vasp')
+
+
+def fixed(atoms: Atoms) -> np.ndarray:
+    """
+    Fixed directions of each atom as read back from the POSCAR
+    """
+    flags = np.zeros((len(atoms), 3), dtype=bool)
+    for constraint in atoms.constraints:
+        if isinstance(constraint, FixAtoms):
+            flags[constraint.index] = True
+        else:
+            flags[constraint.a] |= constraint.mask
+    return flags
+
+
+@pytest.mark.parametrize('write_args', [dict(), dict(sort=True), dict(direct=True),
+                                        dict(sort=True, direct=True, long_format=False)])
+@pytest.mark.parametrize('constrain_adsorbate', [False, True])
+def test_same_as_ase(write_args, constrain_adsorbate):
+    slab = constrained_slab()
+    adsorbate = Atoms('OH', positions=[(0, 0, 0), (0, 0, 0.97)])
+    constraint = None
+    if constrain_adsorbate:
+        # fix the O in z and the H completely
+        constraint = [FixAtoms(indices=list(slab.constraints[0].index) + [len(slab) + 1]),
+                      FixScaled(slab.cell, len(slab), [False, False, True])]
+    writer = PoscarWriter(slab, adsorbate, constraint, **write_args)
+
+    for shift in [(1.2, 0.7, 2.0), (2.5, 1.4, 1.6)]:
+        positions = adsorbate.positions + slab.positions[-1] + shift
+        atoms = slab + Atoms(adsorbate.symbols, positions)
+        atoms.set_constraint(constraint or slab.constraints)
+        fd = StringIO()
+        write(fd, atoms, format='vasp', **write_args)
+
+        expected = read_poscar(fd.getvalue())
+        written = read_poscar(writer.format(positions))
+        assert written.get_chemical_symbols() == expected.get_chemical_symbols()
+        assert np.allclose(written.positions, expected.positions, atol=1e-5)
+        assert np.allclose(written.cell, expected.cell)
+        assert (fixed(written) == fixed(expected)).all()
+
+
+def test_no_constraints():
+    slab = fcc111('Pt', (2, 2, 3), vacuum=5)
+    adsorbate = Atoms('O', positions=[(0, 0, 0)])
+    positions = slab.positions[-1:] + (0, 0, 2)
+    text = PoscarWriter(slab, adsorbate).format(positions)
+    assert 'Selective' not in text
+    atoms = read_poscar(text)
+    assert np.allclose(atoms.positions[-1], positions[0])
+    assert not atoms.constraints
@@ -0,0 +1,250 @@
+import asyncio
+import csv
+import threading
+import time
+from os import path, stat
+from typing import Dict, Iterable, List
+
+from instrumentation import count
+from manifest import JobManifest
+from outcar import read_results
+from submit import Scheduler, VaspScheduler
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+# jobs the watcher waits for
+ACTIVE = ('pending', 'submitted')
+
+
+class Stage:
+    """
+    Step run by the CampaignWatcher after a job finishes, e.g. a single point
+    on the relaxed structure. `run` is called in a thread, it must not use the
+    manifest nor change the working directory
+    """
+    def applies(self, ID: str) -> bool:
+        return True
+
+    def run(self, ID: str, results: dict, energies: Dict[str, float]) -> Iterable[str]:
+        """
+        :param ID: ID of the finished job
+        :param results: see `outcar.read_results`
+        :param energies: Dict[ID, energy] of the jobs finished so far, a copy
+            the watcher doesn't change while the stage runs
+        :return: IDs of the new jobs submitted by the stage, the watcher waits for them too
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases the resources of the stage, called when the watcher returns
+        """
+        pass
+
+
+class SinglePoint(Stage):
+    """
+    Submits a single point calculation on the relaxed structure of each job,
+    as `<job ID>/<name>`
+    """
+    def __init__(self, config: dict, scheduler: Scheduler=None, name: str='single_point'):
+        """
+        :param config: calculator settings, the ionic relaxation is turned off
+        :param scheduler: Scheduler, VaspScheduler if None
+        :param name: name of the directory of the single point in the job directory
+        """
+        self.config = dict(config, ibrion=-1, nsw=0)
+        self.scheduler = scheduler or VaspScheduler()
+        self.name = name
+        # one executor for all the single points, created by the first one
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def applies(self, ID: str) -> bool:
+        return path.basename(ID) != self.name
+
+    def run(self, ID: str, results: dict, energies: Dict[str, float]) -> List[str]:
+        from ase.io import read
+
+        atoms = read(path.join(ID, 'CONTCAR'), format='vasp')
+        single_point = path.join(ID, self.name)
+        # e.g. the vasp calculator changes the working directory of its process,
+        # which the other stages and checks of the watcher depend on
+        with self.lock:
+            if self.pool is None:
+                self.pool = self.scheduler.executor(1)
+        energy = self.pool.submit(self.scheduler.submit, single_point, atoms,
+                                  self.config).result()
+        logger.info(f'{single_point}: submitted')
+        return [single_point] if energy is None else []
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+class AdsorptionEnergies(Stage):
+    """
+    Writes the adsorption energy of every finished job,
+    E(slab + adsorbate) - E(slab) - E(reference)
+    """
+    def __init__(self, slab_energy: float, reference_energy: float,
+                 fname: str='adsorption.csv', stage: str=None):
+        """
+        :param slab_energy: energy of the clean slab
+        :param reference_energy: energy of the adsorbate reference, e.g. 1/2 E(O2)
+        :param fname: CSV file, a row is appended each time a job finishes
+        :param stage: only collect the jobs of this stage, e.g. 'single_point'
+        """
+        self.slab_energy = slab_energy
+        self.reference_energy = reference_energy
+        self.fname = fname
+        self.stage = stage
+        self.lock = threading.Lock()
+
+    def applies(self, ID: str) -> bool:
+        return self.stage is None or path.basename(ID) == self.stage
+
+    def run(self, ID: str, results: dict, energies: Dict[str, float]) -> List[str]:
+        energy = results['energy']
+        with self.lock:
+            # the rows of the jobs finished by earlier watchers are kept
+            header = not path.isfile(self.fname)
+            with open(self.fname, 'a', newline='') as f:
+                writer = csv.writer(f)
+                if header:
+                    writer.writerow(['job', 'energy', 'adsorption_energy'])
+                writer.writerow([ID, energy, energy - self.slab_energy - self.reference_energy])
+        return []
+
+
+class CampaignWatcher:
+    """
+    Follows the jobs of a campaign until they finish.
+    Each poll only stats the OUTCAR of the unfinished jobs, the OUTCARs that
+    changed since the last poll are read from their end in worker threads.
+    Finished jobs are recorded in the manifest and passed to the stages
+    """
+    def __init__(self, manifest: str='jobs.sqlite', stages: Iterable[Stage]=(),
+                 interval: float=30., max_concurrent: int=4):
+        """
+        :param manifest: job manifest of the campaign, job IDs are their directories
+        :param stages: Stage run after each job finishes, in order
+        :param interval: seconds between polls
+        :param max_concurrent: maximum number of OUTCARs read or stages run at once
+        """
+        self.manifest = JobManifest(manifest)
+        self.stages = list(stages)
+        self.interval = interval
+        self.max_concurrent = max_concurrent
+        self.mtimes = dict()
+        self.energies = {job['id']: job['energy']
+                         for job in self.manifest.jobs(['finished'])}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.manifest.close()
+
+    def changed(self, ID: str) -> bool:
+        """
+        Whether the OUTCAR of a job changed since the last poll
+        """
+        try:
+            mtime = stat(path.join(ID, 'OUTCAR')).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if self.mtimes.get(ID) == mtime:
+            return False
+        self.mtimes[ID] = mtime
+        return True
+
+    async def check(self, ID: str, semaphore: asyncio.Semaphore):
+        """
+        Reads the outputs of a job and runs the stages if it finished,
+        a job whose outputs or stages raise is marked failed
+        """
+        try:
+            await self.follow(ID, semaphore)
+        except Exception as e:
+            logger.error(f'{ID}: failed\n{e!r}')
+            count('watcher', status='failed')
+            self.manifest.update(ID, 'failed', self.energies.get(ID))
+
+    async def follow(self, ID: str, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            results = await asyncio.to_thread(read_results, ID)
+        if not results.get('finished'):
+            return
+        if not results.get('converged'):
+            logger.warning(f'{ID}: finished without converging')
+            count('watcher', status='unconverged')
+            self.manifest.update(ID, 'unconverged', results.get('energy'))
+            return
+
+        logger.info(f'{ID}: finished, energy {results["energy"]}')
+        count('watcher', status='finished')
+        self.manifest.update(ID, 'finished', results['energy'])
+        self.energies[ID] = results['energy']
+        for stage in self.stages:
+            if not stage.applies(ID):
+                continue
+            async with semaphore:
+                new_jobs = await asyncio.to_thread(stage.run, ID, results,
+                                                   dict(self.energies))
+            for new_ID in new_jobs or ():
+                self.manifest.update(new_ID, 'submitted')
+
+    async def poll(self) -> int:
+        """
+        Checks the unfinished jobs once
+        :return: number of unfinished jobs left
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        jobs = [job['id'] for job in self.manifest.jobs(ACTIVE)]
+        changed = [ID for ID in jobs if self.changed(ID)]
+        count('watcher', len(changed), status='changed')
+        await asyncio.gather(*(self.check(ID, semaphore) for ID in changed))
+        self.manifest.commit()
+        return len(self.manifest.jobs(ACTIVE))
+
+    async def watch(self, timeout: float=None) -> str:
+        """
+        Polls the campaign every `interval` seconds until all the jobs finish
+        :param timeout: seconds before giving up, no limit if None
+        :return: state of the campaign
+        """
+        start = time.monotonic()
+        try:
+            while True:
+                left = await self.poll()
+                if not left:
+                    break
+                if timeout is not None and time.monotonic() - start + self.interval > timeout:
+                    logger.info(f'watcher stopped after {timeout} s')
+                    break
+                await asyncio.sleep(self.interval)
+        finally:
+            for stage in self.stages:
+                stage.close()
+        return self.state()
+
+    def state(self) -> str:
+        jobs_finished, all_jobs = self.manifest.summary()
+        return f'{jobs_finished}/{all_jobs} jobs finished'
+
+
+def watch(manifest: str='jobs.sqlite', stages: Iterable[Stage]=(), interval: float=30.,
+          max_concurrent: int=4, timeout: float=None) -> str:
+    """
+    Runs a CampaignWatcher until all the jobs finish, see `CampaignWatcher`
+    """
+    with CampaignWatcher(manifest, stages, interval, max_concurrent) as watcher:
+        return asyncio.run(watcher.watch(timeout))
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from typing import Dict, Iterable, Iterator, Tuple
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+from ase.atoms import Atoms
+from ase.io import write
+
+import logging
+
+logger = logging.getLogger('curlywaddle')
+
+
+def fixed_directions(atoms: Atoms) -> np.ndarray:
+    """
+    Directions each atom can't move along, from its FixAtoms and FixScaled constraints,
+    i.e. the selective dynamics of the POSCAR
+    :param atoms: Atoms
+    :return: (n, 3) bool array, None if there are no constraints
+    """
+    from ase.constraints import FixAtoms, FixScaled
+
+    if not atoms.constraints:
+        return None
+    fixed = np.zeros((len(atoms), 3), dtype=bool)
+    for constraint in atoms.constraints:
+        if isinstance(constraint, FixAtoms):
+            fixed[constraint.index] = True
+        elif isinstance(constraint, FixScaled):
+            # `a` in older versions of ASE
+            index = getattr(constraint, 'index', getattr(constraint, 'a', None))
+            fixed[index] |= np.asarray(constraint.mask, dtype=bool)
+    return fixed
+
+
+class PoscarWriter:
+    """
+    POSCAR writer for structures that share the same slab and only differ
+    in the positions of the adsorbate.
+    The header and the (sorted) slab lines with their constraint flags are
+    formatted once by ASE, each structure only formats the adsorbate lines,
+    their flags are built from the constraints
+    """
+    def __init__(self, slab: Atoms, adsorbate: Atoms, constraint=None, **write_args):
+        """
+        :param slab: Atoms
+        :param adsorbate: Atoms, only its symbols are used
+        :param constraint: constraints of slab + adsorbate, slab constraints if None
+        :param write_args: `ase.io.write` arguments, e.g. `direct`, `sort`
+        """
+        write_args.setdefault('format', 'vasp')
+        self.n_slab = len(slab)
+        self.direct = write_args.get('direct', False)
+        long_format = write_args.get('long_format', True)
+        self.coord_format = (' %19.16f' if long_format else ' %9.6f') * 3
+        self.inv_cell = np.linalg.inv(slab.cell)
+
+        template = slab + adsorbate
+        if constraint is not None:
+            template.set_constraint(constraint)
+        fd = StringIO()
+        write(fd, template, **write_args)
+        lines = fd.getvalue().splitlines(keepends=True)
+        n_atoms = len(template)
+        self.header = ''.join(lines[:-n_atoms])
+        self.lines = lines[-n_atoms:]
+
+        # same ordering as ase.io.vasp.write_vasp
+        if write_args.get('sort'):
+            order = np.argsort(template.get_chemical_symbols())
+        else:
+            order = np.arange(n_atoms)
+        # line of each adsorbate atom and its constraint flags
+        self.ads_lines = np.argsort(order)[self.n_slab:]
+        fixed = fixed_directions(template)
+        if fixed is None:
+            self.flags = ['\n'] * len(adsorbate)
+        else:
+            self.flags = [''.join(f'{"F" if f else "T":>4}' for f in fixed[i]) + '\n'
+                          for i in range(self.n_slab, n_atoms)]
+
+    def format(self, positions: np.ndarray) -> str:
+        """
+        Returns the POSCAR text with the adsorbate at `positions`
+        :param positions: cartesian positions of the adsorbate atoms
+        :return: str
+        """
+        coords = np.asarray(positions) @ self.inv_cell if self.direct else positions
+        lines = list(self.lines)
+        for k, coord, flags in zip(self.ads_lines, coords, self.flags):
+            lines[k] = self.coord_format % tuple(coord) + flags
+        return self.header + ''.join(lines)
+
+    def write(self, fname: str, positions: np.ndarray):
+        with open(fname, 'w') as f:
+            f.write(self.format(positions))
+
+
+def content_digest(text: str, salt: str='') -> str:
+    """
+    Hash of the content of an input file
+    :param text: file content
+    :param salt: e.g. hash of the calculator settings used with the file
+    :return: hex digest
+    """
+    return hashlib.sha1((salt + text).encode()).hexdigest()
+
+
+def write_poscars(writer: PoscarWriter, items: Iterable[Tuple[str, np.ndarray]],
+                  n_workers: int=8, makedirs: bool=False, digests: Dict[str, str]=None,
+                  salt: str='') -> Iterator[Tuple[str, str, Exception]]:
+    """
+    Writes the POSCAR files using a pool of threads, at most `2*n_workers`
+    structures are pending at any time.
+    If `digests` is given, files that exist and whose content digest is
+    unchanged are not rewritten
+    :param writer: PoscarWriter
+    :param items: iterable of (filename, adsorbate positions)
+    :param n_workers: number of threads
+    :param makedirs: create the directory of each file if it doesn't exist
+    :param digests: Dict[filename, digest] of the files written before
+    :param salt: salt of the content digests
+    :return: Tuple[filename, digest or None if the file was skipped, exception raised or None],
+        in the order of `items`
+    """
+    def write_one(fname, positions):
+        try:
+            text = writer.format(positions)
+            digest = content_digest(text, salt)
+            if digests is not None and digests.get(fname) == digest and os.path.isfile(fname):
+                return None, None
+            directory = os.path.dirname(fname)
+            if makedirs and directory and not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+                logger.debug(f'directory {directory} created')
+            with open(fname, 'w') as f:
+                f.write(text)
+            return digest, None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(n_workers) as pool:
+        pending = deque()
+        for fname, positions in items:
+            pending.append((fname, pool.submit(write_one, fname, positions)))
+            if len(pending) >= 2 * n_workers:
+                fname, future = pending.popleft()
+                yield (fname, *future.result())
+        while pending:
+            fname, future = pending.popleft()
+            yield (fname, *future.result())
+
+
+class PoscarArchive:
+    """
+    Single zip archive with the POSCAR of every job, indexed by a manifest.
+    Members are stored as `{ID}/{name}` so they can be read individually
+    or expanded into job directories when the jobs are submitted
+    """
+    manifest_name = 'manifest.json'
+
+    def __init__(self, fname: str, mode: str='r'):
+        """
+        :param fname: archive filename
+        :param mode: 'r' to read, 'w' to write a new archive
+        """
+        if mode not in ('r', 'w'):
+            raise ValueError(f'mode "{mode}" not recognized.')
+        self.fname = fname
+        self.mode = mode
+        self.zip = ZipFile(fname, mode, compression=ZIP_DEFLATED)
+        if mode == 'r':
+            self.manifest = json.loads(self.zip.read(self.manifest_name))
+        else:
+            self.manifest = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, ID: str):
+        return ID in self.manifest
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.manifest)
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def close(self):
+        if self.mode == 'w':
+            self.zip.writestr(self.manifest_name, json.dumps(self.manifest, indent=1))
+        self.zip.close()
+
+    def add(self, ID: str, text: str, name: str='POSCAR.vasp', **info):
+        """
+        Adds the file of a job to the archive
+        :param ID: job ID
+        :param text: file content
+        :param name: filename inside the job directory
+        :param info: extra information stored in the manifest
+        """
+        member = f'{ID}/{name}'
+        self.zip.writestr(member, text)
+        self.manifest[ID] = dict(path=member, **info)
+
+    def read(self, ID: str) -> str:
+        return self.zip.read(self.manifest[ID]['path']).decode()
+
+    def extract(self, ID: str, directory: str='.') -> str:
+        """
+        Writes the file of the job in its directory
+        :param ID: job ID
+        :param directory: parent directory of the job directories
+        :return: path of the written file
+        """
+        return self.zip.extract(self.manifest[ID]['path'], directory)
+
+
+def write_archive(archive: PoscarArchive, writer: PoscarWriter,
+                  items: Iterable[Tuple[str, np.ndarray]],
+                  salt: str='') -> Iterator[Tuple[str, str, Exception]]:
+    """
+    Writes the POSCAR of each job into the archive
+    :param archive: PoscarArchive opened for writing
+    :param writer: PoscarWriter
+    :param items: iterable of (ID, adsorbate positions)
+    :param salt: salt of the content digests
+    :return: Tuple[ID, digest, exception raised or None]
+    """
+    for ID, positions in items:
+        try:
+            text = writer.format(positions)
+            digest = content_digest(text, salt)
+            archive.add(ID, text, digest=digest)
+            yield (ID, digest, None)
+        except Exception as e:
+            yield (ID, None, e)